@@ -0,0 +1,158 @@
+"""
+Benchmarks for parsing and importing ArArCALC workbooks.
+
+Run from the `import-pipeline` directory:
+
+    python -m benchmarks --steps 10 --steps 40 --files 50
+
+Each case runs in a fresh process so peak memory is measured
+separately. Results are appended to a history file and compared
+with the previous run of the same case.
+
+The `--import` option also times a full `MAPImporter` import. This
+needs a Sparrow environment (e.g. `sparrow compose run`) whose
+database is a throwaway instance, since synthetic sessions are written.
+"""
+import json
+import resource
+import warnings
+from datetime import datetime
+from time import perf_counter
+from tempfile import TemporaryDirectory
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from click import command, option, echo, secho, Choice
+
+from pipeline.extract_tables import extract_data_tables
+from pipeline.parallel import iter_parsed
+from pipeline.manifest import get_cache_directory
+from .synthetic import write_workbooks
+
+# Slowdown relative to the previous run that is reported as a regression
+tolerance = 0.1
+
+
+def peak_rss():
+    """Peak resident memory of this process and its children, in MB"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children)/1024
+
+
+def parse_case(files, jobs):
+    start = perf_counter()
+    if jobs > 1:
+        for fn, job in iter_parsed(files, jobs=jobs):
+            job.result()
+    else:
+        for fn in files:
+            extract_data_tables(fn)
+    return perf_counter()-start, peak_rss()
+
+
+def import_case(files, jobs, bulk):
+    from sparrow import construct_app
+    from pipeline.importer import MAPImporter
+
+    app, db = construct_app(minimal=True)
+    importer = MAPImporter(db, bulk=bulk)
+    start = perf_counter()
+    importer.iterfiles(files, redo=True, jobs=jobs)
+    return perf_counter()-start, peak_rss()
+
+
+def run_case(func, *args):
+    # Pandas chained-assignment warnings from the parser drown out the report
+    warnings.simplefilter("ignore")
+    return func(*args)
+
+
+def run_isolated(func, *args):
+    # A single-use worker process gives each case its own peak RSS
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(run_case, func, *args).result()
+
+
+def load_history(path):
+    if not path.exists():
+        return []
+    with path.open() as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_result(history, case):
+    for record in reversed(history):
+        if record['case'] == case:
+            return record
+    return None
+
+
+def report(record, previous):
+    msg = (f"{record['case']:<40}{record['files_per_sec']:>10.1f} files/s"
+           f"{record['peak_rss_mb']:>10.0f} MB")
+    if previous is None:
+        echo(msg)
+        return
+    change = previous['files_per_sec']/record['files_per_sec'] - 1
+    msg += f"  ({change*100:+.0f}% time vs. {previous['timestamp'][:10]})"
+    if change > tolerance:
+        secho(msg+"  REGRESSION", fg='red')
+    else:
+        echo(msg)
+
+
+@command()
+@option('--steps', '-s', type=int, multiple=True, default=[12, 40],
+        help="Heating steps per synthetic file (can be repeated)")
+@option('--files', '-n', type=int, default=50,
+        help="Number of synthetic files per case")
+@option('--jobs', '-j', type=int, multiple=True, default=[1],
+        help="Parser processes (can be repeated)")
+@option('--format', 'format', type=Choice(['xls', 'xlsx']), default='xls',
+        help="Format of the synthetic files (data files are .xls)")
+@option('--import', 'run_import', is_flag=True, default=False,
+        help="Also time a full import into the Sparrow database")
+@option('--bulk', is_flag=True, default=False,
+        help="Use bulk heating-step writes for the import benchmark")
+@option('--history', type=str, default=None,
+        help="File to which results are appended")
+def benchmark(steps, files, jobs, format, run_import, bulk, history):
+    """
+    Time parsing (and optionally importing) synthetic ArArCALC files.
+    """
+    if history is None:
+        history = get_cache_directory()/"benchmarks.jsonl"
+    history = Path(history)
+    past = load_history(history)
+    records = []
+
+    with TemporaryDirectory() as tmp:
+        for n_steps in steps:
+            fns = write_workbooks(Path(tmp)/str(n_steps), files, n_steps=n_steps,
+                                  suffix="."+format)
+            cases = [(f"parse {format} steps={n_steps} jobs={j}", parse_case, (fns, j))
+                     for j in jobs]
+            if run_import:
+                cases += [(f"import {format} steps={n_steps} jobs={j} bulk={bulk}", import_case, (fns, j, bulk))
+                          for j in jobs]
+            for case, func, args in cases:
+                elapsed, rss = run_isolated(func, *args)
+                record = dict(
+                    case=case,
+                    timestamp=datetime.now().isoformat(),
+                    n_files=files,
+                    elapsed=elapsed,
+                    files_per_sec=files/elapsed,
+                    peak_rss_mb=rss)
+                report(record, previous_result(past, case))
+                records.append(record)
+
+    history.parent.mkdir(parents=True, exist_ok=True)
+    with history.open("a") as f:
+        for record in records:
+            f.write(json.dumps(record)+"\n")
+    secho(f"Results appended to {history}", dim=True)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,154 @@
+"""
+Query plans and timings of the cleanup, metrics and export queries
+with and without the indexes in `sql/indexes.sql`. Run from the
+`import-pipeline` directory against a local Sparrow database:
+
+    python -m benchmarks.indexes --database postgresql://postgres@localhost:54321/sparrow
+
+Each variant runs in a transaction that is rolled back: "before" drops
+the indexes and "after" creates any that are missing. Dropping an index
+locks its table until the transaction ends, so don't run this against
+a database that is in use.
+"""
+import json
+import re
+from datetime import datetime
+from statistics import median
+from pathlib import Path
+from click import command, option, echo, secho
+from sqlalchemy import create_engine, text
+
+from pipeline.manifest import get_cache_directory
+
+root = Path(__file__).parent.parent
+plugins = root.parent/"site-content"/"backend-plugins"
+index_sql = root/"sql"/"indexes.sql"
+
+
+def cleanup_queries():
+    # The subqueries that select the ages accepted by clean-data.sql
+    sql = (root/"pipeline"/"sql"/"clean-data.sql").read_text()
+    selects = re.findall(r"WHERE id IN \((.*?)\);", sql, re.DOTALL)
+    return {f"clean-data {i+1}": (q, {}) for i, q in enumerate(selects)}
+
+
+def queries():
+    res = cleanup_queries()
+    res["metrics"] = ((plugins/"metrics.sql").read_text(), {})
+    res["export technique"] = ((plugins/"export.sql").read_text(),
+        dict(project=None, sample=None, technique="Ar/Ar Incremental Heating"))
+    res["accepted ages"] = ("""
+        SELECT s.sample_id, dt.parameter, d.value, d.error
+        FROM datum d
+        JOIN datum_type dt ON dt.id = d.type
+        JOIN analysis a ON a.id = d.analysis
+        JOIN session s ON s.id = a.session_id
+        WHERE d.is_accepted
+          AND dt.parameter IN ('plateau_age', 'total_fusion_age')""", {})
+    res["plateau steps"] = ("""
+        SELECT a.session_id, count(*)
+        FROM analysis a
+        WHERE a.in_plateau
+        GROUP BY a.session_id""", {})
+    res["session heating steps"] = ("""
+        SELECT a.session_index, a.id
+        FROM analysis a
+        WHERE a.session_id = (SELECT max(id) FROM session)
+          AND a.analysis_type = 'Heating step'""", {})
+    res["analysis data key"] = ("""
+        SELECT a.id FROM analysis a WHERE a.data ? 'MSWD'""", {})
+    return res
+
+
+def index_statements():
+    sql = re.sub(r"/\*.*?\*/", "", index_sql.read_text(), flags=re.DOTALL)
+    statements = [s.strip() for s in sql.split(";")]
+    return [s for s in statements if s and s.upper() != "COMMIT"]
+
+
+def index_names():
+    return re.findall(r"CREATE INDEX IF NOT EXISTS (\w+)", index_sql.read_text())
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(conn, sql, params, repeat):
+    times = []
+    for i in range(repeat):
+        res = conn.execute(text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "+sql), **params)
+        plan = res.scalar()[0]
+        times.append(plan["Planning Time"]+plan["Execution Time"])
+    indexes = {node["Index Name"] for node in plan_nodes(plan["Plan"]) if "Index Name" in node}
+    return dict(
+        elapsed_ms=median(times),
+        node=plan["Plan"]["Node Type"],
+        shared_read=plan["Plan"].get("Shared Read Blocks", 0),
+        indexes=sorted(indexes))
+
+
+def run_variant(engine, setup, cases, repeat):
+    with engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            for statement in setup:
+                conn.execute(text(statement))
+            return {name: explain(conn, sql, params, repeat)
+                    for name, (sql, params) in cases.items()}
+        finally:
+            trans.rollback()
+
+
+@command()
+@option('--database', type=str, default="postgresql://postgres@localhost:54321/sparrow",
+        help="Database URL")
+@option('--repeat', '-n', type=int, default=3,
+        help="Number of runs of each query")
+@option('--verbose', '-v', is_flag=True, default=False,
+        help="Show the indexes used by each plan")
+@option('--history', type=str, default=None,
+        help="File to which results are appended")
+def benchmark_indexes(database, repeat, verbose, history):
+    """
+    Compare query plans with and without the WiscAr index pack.
+    """
+    if history is None:
+        history = get_cache_directory()/"index-benchmarks.jsonl"
+    history = Path(history)
+    engine = create_engine(database)
+    cases = queries()
+
+    drop = [f"DROP INDEX IF EXISTS {name}" for name in index_names()]
+    before = run_variant(engine, drop, cases, repeat)
+    after = run_variant(engine, index_statements(), cases, repeat)
+
+    records = []
+    for name in cases:
+        b, a = before[name], after[name]
+        speedup = b['elapsed_ms']/max(a['elapsed_ms'], 1e-3)
+        msg = (f"{name:<24}{b['elapsed_ms']:>10.1f} ms{a['elapsed_ms']:>10.1f} ms"
+               f"{speedup:>8.1f}x  {b['node']} → {a['node']}")
+        secho(msg, fg='red' if speedup < 1 else None)
+        if verbose:
+            secho(f"    {', '.join(a['indexes']) or 'no indexes'}", dim=True)
+        records.append(dict(case=name, timestamp=datetime.now().isoformat(),
+                            before=b, after=a))
+
+    # Every index slows down imports, so each should serve some query
+    used = {ix for a in after.values() for ix in a['indexes']}
+    unused = [name for name in index_names() if name not in used]
+    if unused:
+        secho(f"Not used by any query: {', '.join(unused)}", fg='yellow')
+
+    history.parent.mkdir(parents=True, exist_ok=True)
+    with history.open("a") as f:
+        for record in records:
+            f.write(json.dumps(record)+"\n")
+    secho(f"Results appended to {history}", dim=True)
+
+
+if __name__ == '__main__':
+    benchmark_indexes()
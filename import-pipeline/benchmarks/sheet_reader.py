@@ -0,0 +1,112 @@
+"""
+Checks that the streaming sheet reader extracts the same tables as
+`read_excel`. Run from the `import-pipeline` directory:
+
+    python -m benchmarks.sheet_reader [FILES OR DIRECTORIES]
+
+Without arguments, the `.xls` fixtures in `test-data` are checked,
+along with synthetic workbooks in both formats. Production data files
+are legacy `.xls` workbooks, so point this at a copy of the data
+directory after changing the reader.
+"""
+import warnings
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from click import command, argument, option, echo, secho
+import numpy as N
+
+from pipeline.extract_tables import extract_data_tables
+from .synthetic import write_workbook
+
+root = Path(__file__).parent.parent
+fixtures = root/"test-data"
+
+
+def extract(fn, streaming):
+    try:
+        return extract_data_tables(fn, streaming=streaming)
+    except Exception as exc:
+        return exc
+
+
+def differences(fn):
+    """
+    Descriptions of the tables that differ between the two readers. Files
+    that neither reader can parse raise the parser's error.
+    """
+    tables = extract(fn, streaming=True)
+    _tables = extract(fn, streaming=False)
+    if isinstance(_tables, Exception):
+        if isinstance(tables, Exception) and str(tables) == str(_tables):
+            raise _tables
+        return ["read_excel error: "+str(_tables)]
+    if isinstance(tables, Exception):
+        return ["streaming error: "+str(tables)]
+    heating, info, results = tables
+    _heating, _info, _results = _tables
+    diff = []
+    if (heating.steps != _heating.steps
+            or not N.array_equal(heating.in_plateau, _heating.in_plateau)
+            or not N.array_equal(heating.values, _heating.values, equal_nan=True)
+            or not N.array_equal(heating.errors, _heating.errors, equal_nan=True)
+            or heating.error_metrics != _heating.error_metrics):
+        diff.append("heating steps differ")
+    if not info.equals(_info):
+        diff.append("information differ")
+    if not (results.equals(_results) and list(results.columns) == list(_results.columns)):
+        diff.append("results differ")
+    return diff
+
+
+def synthetic_files(directory):
+    files = []
+    for suffix in (".xls", ".xlsx"):
+        for n_steps, plateau, fusion in [(12, True, False), (40, False, False), (8, True, True)]:
+            fn = Path(directory)/f"synthetic-{n_steps}-{plateau}-{fusion}{suffix}"
+            write_workbook(fn, n_steps=n_steps, plateau=plateau, fusion=fusion)
+            files.append(fn)
+    return files
+
+
+def expand(paths):
+    for p in paths:
+        p = Path(p)
+        if p.is_dir():
+            yield from sorted(p.glob("**/*.xls"))
+        else:
+            yield p
+
+
+@command()
+@argument('paths', nargs=-1, type=str)
+@option('--verbose', '-v', is_flag=True, default=False)
+def check_sheet_reader(paths, verbose):
+    """
+    Compare tables read with and without the streaming sheet reader.
+    """
+    # Pandas chained-assignment warnings from the parser drown out the report
+    warnings.simplefilter("ignore")
+    with TemporaryDirectory() as tmp:
+        if paths:
+            files = list(expand(paths))
+        else:
+            files = sorted(fixtures.glob("*.xls")) + synthetic_files(tmp)
+        failed = 0
+        for fn in files:
+            try:
+                diff = differences(fn)
+            except Exception as exc:
+                secho(f"{fn.name}: not parsed by either reader ({exc})", fg='yellow')
+                continue
+            if diff:
+                failed += 1
+                secho(f"{fn.name}: {'; '.join(diff)}", fg='red')
+            elif verbose:
+                echo(f"{fn.name}: OK")
+    echo(f"{len(files)-failed} of {len(files)} files match")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    check_sheet_reader()
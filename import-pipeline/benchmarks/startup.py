@@ -0,0 +1,98 @@
+"""
+Startup time of the import CLI, which matters for the `bin/` wrappers
+when they are run from cron. Run from the `import-pipeline` directory:
+
+    python -m benchmarks.startup
+
+Also checks that heavy dependencies aren't imported when the CLI
+module is loaded.
+"""
+import json
+import subprocess
+import sys
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+from pathlib import Path
+from click import command, option, echo, secho
+
+from pipeline.manifest import get_cache_directory
+
+commands = [
+    ["--help"],
+    ["import-map", "--help"],
+    ["validate-map", "--help"],
+]
+
+# Modules that should only be imported by the commands that need them
+heavy_modules = ["pandas", "numpy", "sqlalchemy", "sparrow", "openpyxl", "xlrd"]
+
+# Slowdown relative to the previous run that is reported as a regression
+tolerance = 0.2
+
+
+def time_command(args, repeat):
+    times = []
+    for i in range(repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable, "-m", "pipeline", *args],
+                       stdout=subprocess.DEVNULL, check=True)
+        times.append(perf_counter()-start)
+    return median(times)
+
+
+def loaded_heavy_modules():
+    code = ("import sys, pipeline.cli; "
+            f"print(' '.join(m for m in {heavy_modules!r} if m in sys.modules))")
+    res = subprocess.run([sys.executable, "-c", code],
+                         capture_output=True, text=True, check=True)
+    return res.stdout.split()
+
+
+@command()
+@option('--repeat', '-n', type=int, default=10,
+        help="Number of runs of each command")
+@option('--history', type=str, default=None,
+        help="File to which results are appended")
+def startup(repeat, history):
+    """
+    Time how long the import CLI takes to start.
+    """
+    if history is None:
+        history = get_cache_directory()/"startup-benchmarks.jsonl"
+    history = Path(history)
+    past = {}
+    if history.exists():
+        with history.open() as f:
+            for line in f:
+                record = json.loads(line)
+                past[record['case']] = record
+
+    heavy = loaded_heavy_modules()
+    if heavy:
+        secho(f"Loading pipeline.cli imports {', '.join(heavy)}", fg='red')
+
+    records = []
+    for args in commands:
+        case = "pipeline "+" ".join(args)
+        elapsed = time_command(args, repeat)
+        msg = f"{case:<36}{elapsed*1000:>8.0f} ms"
+        previous = past.get(case)
+        if previous is not None:
+            change = elapsed/previous['elapsed'] - 1
+            msg += f"  ({change*100:+.0f}% vs. {previous['timestamp'][:10]})"
+            if change > tolerance:
+                msg += "  REGRESSION"
+        secho(msg, fg='red' if "REGRESSION" in msg else None)
+        records.append(dict(case=case, timestamp=datetime.now().isoformat(),
+                            elapsed=elapsed))
+
+    history.parent.mkdir(parents=True, exist_ok=True)
+    with history.open("a") as f:
+        for record in records:
+            f.write(json.dumps(record)+"\n")
+    secho(f"Results appended to {history}", dim=True)
+
+
+if __name__ == '__main__':
+    startup()
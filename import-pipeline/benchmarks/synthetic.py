@@ -0,0 +1,120 @@
+from random import Random
+from pathlib import Path
+from openpyxl import Workbook
+
+# Column labels of the Incremental Heating table
+heating_labels = ["Incremental\nHeating", "Temp", None, "36Ar(a)\n[V]", "37Ar(ca)\n[V]",
+                  "38Ar(cl)\n[V]", "39Ar(k)\n[V]", "40Ar(r)\n[V]", "Age\n(Ma)", "± 2σ\n(Ma)",
+                  "40Ar(r)\n(%)", "39Ar(k)\n(%)", "K/Ca", "± 2σ"]
+
+results_labels = ["Results", "40(r)/39(k)", "± 2σ", "Age", "± 2σ", "MSWD", "39Ar(k)", "K/Ca", "± 2σ"]
+
+
+def heating_rows(rng, n_steps, fusion=False):
+    rows = [heating_labels, [None, "[°C]"]]
+    for i in range(n_steps):
+        T = 1000 if fusion else 600+50*i
+        in_plateau = "✓" if 2 < i < n_steps-1 else None
+        rows.append([f"{i+1}A", T, in_plateau]+[rng.random() for _ in range(11)])
+    # Totals row, which is dropped by the parser
+    rows.append(["Σ", None, None]+[1.0]*5)
+    return rows
+
+
+def information_rows(sample, project):
+    return [
+        "Information\non Analysis",
+        f"Sample = {sample}",
+        "Material = gmass",
+        f"Project = {project}",
+        "J = 0.0012345 ± 0.0000012",
+        "Location = Pos 3",
+        "Analyst = Synthetic",
+        "Mass Discrimination Law = LIN",
+        "FC = 28.201 ± 0.046 Ma"]
+
+
+def results_rows(rng, n_steps, plateau=True):
+    age = 10+20*rng.random()
+    comment = "" if plateau else "Cannot Calculate"
+    return [
+        results_labels,
+        [None, None, None, "(Ma)", None, None, "(%,n)"],
+        ["Age Plateau\n"+comment, 1.1, 0.01, age, 0.2, 1.2, 95.2, 0.5, 0.1],
+        [None, None, "± 0.9%", None, "± 1%", None, max(n_steps-4, 1)],
+        ["Full External Error", None, None, None, 0.3, 1.96, "2σ Confidence Limit"],
+        ["Analytical Error", None, None, None, 0.1, 1.0, "Error Magnification"],
+        ["Total Fusion Age", 1.2, 0.02, age+0.2, 0.3, None, n_steps, 0.6, 0.1],
+        [None, None, "± 1%", None, "± 1.2%"],
+        ["Full External Error", None, None, None, 0.4],
+        ["Analytical Error", None, None, None, 0.2]]
+
+
+def sheet_rows(n_steps=12, sample="SYN-1", project="SYN", seed=0,
+               plateau=True, fusion=False):
+    """
+    Rows of the "Incremental Heating Summary" sheet of an ArArCALC
+    file, with random isotope data.
+    """
+    rng = Random(seed)
+    yield ["Incremental Heating Summary"]
+    yield []
+    yield from heating_rows(rng, n_steps, fusion=fusion)
+    yield []
+
+    # Information on Analysis is in the first column, with the
+    # Results table beside it.
+    info = information_rows(sample, project)
+    results = results_rows(rng, n_steps, plateau=plateau and not fusion)
+    for i in range(max(len(info), len(results))):
+        row = [None]*3
+        row[0] = info[i] if i < len(info) else None
+        if i < len(results):
+            row += results[i]
+        yield row
+
+
+def write_xlsx(fn, sheet_name, rows):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = sheet_name
+    for row in rows:
+        ws.append(row)
+    wb.save(fn)
+
+
+def write_xls(fn, sheet_name, rows):
+    # Legacy workbooks, as written by ArArCALC, need `xlwt`
+    import xlwt
+    wb = xlwt.Workbook(encoding="utf-8")
+    ws = wb.add_sheet(sheet_name)
+    for i, row in enumerate(rows):
+        for j, v in enumerate(row):
+            if v is not None:
+                ws.write(i, j, v)
+    wb.save(str(fn))
+
+
+def write_workbook(fn, **kwargs):
+    """
+    Write a workbook with the layout of the "Incremental Heating Summary"
+    sheet of an ArArCALC file. The format (.xls or .xlsx) is chosen by
+    the file's suffix.
+    """
+    rows = sheet_rows(**kwargs)
+    if Path(fn).suffix.lower() == ".xls":
+        write_xls(fn, "Incremental Heating Summary", rows)
+    else:
+        write_xlsx(fn, "Incremental Heating Summary", rows)
+
+
+def write_workbooks(directory, n_files, n_steps=12, seed=0, suffix=".xls"):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i in range(n_files):
+        fn = directory/f"synthetic-{n_steps}-{i:05d}{suffix}"
+        write_workbook(fn, n_steps=n_steps, sample=f"SYN-{n_steps}-{i}",
+                       seed=seed+i, plateau=(i % 5 != 0))
+        files.append(fn)
+    return files
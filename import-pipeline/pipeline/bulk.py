@@ -0,0 +1,243 @@
+from sqlalchemy import select, bindparam, func, or_
+
+from .vocabulary import cache_key
+
+
+class HeatingStepWriter(object):
+    """
+    Writes the heating steps of an experiment with a handful of
+    multi-row statements per session, instead of creating ORM objects
+    for each analysis and datum. Analysis and datum types are resolved
+    once and reused for the rest of the import run.
+
+    Steps are matched to existing analyses by their index within the
+    session, and datums by their analysis and type, so re-importing a
+    file updates rows in place as the ORM path does.
+
+    Type IDs are kept in the importer's vocabulary cache, which is
+    emptied when the session rolls back.
+    """
+    analysis_type = "Heating step"
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.db = importer.db
+        self.m = importer.m
+
+    def datum_type(self, parameter, **kwargs):
+        return self.importer.vocabulary.get('datum_type', cache_key((parameter,), kwargs),
+            self._datum_type_id, parameter, **kwargs)
+
+    def _datum_type_id(self, parameter, **kwargs):
+        dt = self.importer.datum_type(parameter, **kwargs)
+        self.db.session.flush()
+        return dt.id
+
+    def heating_step_type(self):
+        return self.importer.vocabulary.get('analysis_type', self.analysis_type,
+            self._analysis_type_id)
+
+    def _analysis_type_id(self):
+        at = self.importer.analysis_type(self.analysis_type)
+        self.db.session.flush()
+        return at.id
+
+    def analysis_ids(self, session_id, analysis_type):
+        table = self.m.analysis.__table__
+        q = (select([table.c.session_index, table.c.id])
+            .where(table.c.session_id == session_id)
+            .where(table.c.analysis_type == analysis_type))
+        return dict(self.db.session.execute(q).fetchall())
+
+    def upsert(self, table, existing, rows, match_key):
+        """
+        Insert new rows and update existing ones, with one
+        `executemany` statement for each.
+        """
+        new = []
+        updates = []
+        for row in rows:
+            id = existing.get(match_key(row))
+            if id is None:
+                new.append(row)
+            else:
+                updates.append({'_id': id, **{'_'+k: v for k, v in row.items()}})
+        if new:
+            self.db.session.execute(table.insert(), new)
+        if updates:
+            values = {k[1:]: bindparam(k) for k in updates[0] if k != '_id'}
+            stmt = (table.update()
+                .where(table.c.id == bindparam('_id'))
+                .values(**values))
+            self.db.session.execute(stmt, updates)
+
+    def write(self, session, steps, fields):
+        """
+        Write the analyses and datums for all heating steps of a session.
+
+        :param steps: the session's `HeatingSteps`
+        :param fields: datum specifications from
+            `MAPImporter.heating_step_fields`
+        """
+        # Make sure the session and prior ORM changes are in the database
+        self.db.session.flush()
+
+        analysis = self.m.analysis.__table__
+        datum = self.m.datum.__table__
+        at = self.heating_step_type()
+
+        names = [str(ix) for ix in steps.steps]
+        in_plateau = steps.in_plateau.tolist()
+        rows = [dict(
+                session_id=session.id,
+                session_index=i,
+                analysis_name=name,
+                analysis_type=at,
+                in_plateau=plateau,
+                is_interpreted=False)
+            for i, (name, plateau) in enumerate(zip(names, in_plateau))]
+
+        existing = self.analysis_ids(session.id, at)
+        self.upsert(analysis, existing, rows,
+            lambda r: r['session_index'])
+        ids = self.analysis_ids(session.id, at)
+        analysis_ids = [ids[i] for i in range(len(rows))]
+
+        # Build value and error arrays for each datum type
+        datums = []
+        for column, has_error, parameter, kwargs in fields:
+            type_id = self.datum_type(parameter, **kwargs)
+            values = steps.value(column).tolist()
+            if has_error:
+                errors = steps.error(column).tolist()
+            else:
+                errors = [None]*len(values)
+            for a, v, e in zip(analysis_ids, values, errors):
+                datums.append(dict(analysis=a, type=type_id, value=v, error=e))
+
+        q = (select([datum.c.analysis, datum.c.type, datum.c.id])
+            .where(datum.c.analysis.in_(analysis_ids)))
+        existing = {(a, t): id for a, t, id in self.db.session.execute(q)}
+        self.upsert(datum, existing, datums,
+            lambda r: (r['analysis'], r['type']))
+
+
+class SampleWriter(object):
+    """
+    Upserts the samples listed in the metadata sheet, and their links
+    to geological entities, with a few multi-row statements per batch
+    instead of a transaction for each sample.
+
+    Existing samples are looked up by name along with the "Irradiation ID"
+    of their first session, so that the importer can check irradiations
+    without loading each sample's sessions.
+    """
+    def __init__(self, importer):
+        self.importer = importer
+        self.db = importer.db
+        self.m = importer.m
+
+    def sample_ids(self, names):
+        table = self.m.sample.__table__
+        q = (select([table.c.name, table.c.id])
+            .where(table.c.name.in_(names)))
+        return dict(self.db.session.execute(q).fetchall())
+
+    def existing(self, names):
+        """
+        Find existing samples by name.
+
+        :returns: a mapping of sample name to a dict with the sample `id`
+            and the `irradiation` IDs of its first session, which is
+            `None` if the sample has no sessions.
+        """
+        sample = self.m.sample.__table__
+        session = self.m.session.__table__
+        q = (select([sample.c.name, sample.c.id, session.c.id])
+            .select_from(sample.outerjoin(session, session.c.sample_id == sample.c.id))
+            .where(sample.c.name.in_(names))
+            .order_by(session.c.id))
+        samples = {}
+        first_session = {}
+        for name, id, session_id in self.db.session.execute(q):
+            samples.setdefault(name, dict(id=id, irradiation=None))
+            if session_id is not None:
+                first_session.setdefault(name, session_id)
+
+        m = self.m
+        q = (self.db.session.query(m.analysis.session_id, m.attribute.value)
+            .join(m.analysis.attribute_collection)
+            .filter(m.attribute.parameter == "Irradiation ID")
+            .filter(m.analysis.session_id.in_(set(first_session.values()))))
+        irradiation = {}
+        for session_id, value in q:
+            irradiation.setdefault(session_id, []).append(value)
+
+        for name, session_id in first_session.items():
+            samples[name]['irradiation'] = irradiation.get(session_id, [])
+        return samples
+
+    def geo_entity(self, unit):
+        # IDs are kept in the importer's vocabulary cache, which is
+        # emptied when the session rolls back
+        return self.importer.vocabulary.get('geo_entity', (unit['name'], unit['type']),
+            self._geo_entity_id, unit)
+
+    def _geo_entity_id(self, unit):
+        schema = self.db.interface.geo_entity()
+        entity = schema.load(unit, session=self.db.session)
+        self.db.session.add(entity)
+        self.db.session.flush()
+        return entity.id
+
+    def write(self, rows, existing):
+        """
+        Insert new samples, update the location and material of existing
+        ones, and link samples to their geological units.
+
+        :param rows: dicts with the `name`, `material`, `location` and
+            geological `units` of each sample
+        :param existing: the result of `existing` for these samples
+        """
+        # Make sure vocabulary used by the rows is in the database
+        self.db.session.flush()
+        table = self.m.sample.__table__
+
+        new = []
+        updates = []
+        for row in rows:
+            values = dict(material=row['material'], location=row['location'])
+            sample = existing.get(row['name'])
+            if sample is None:
+                new.append(dict(name=row['name'], **values))
+            else:
+                updates.append({'_id': sample['id'], **{'_'+k: v for k, v in values.items()}})
+        if new:
+            self.db.session.execute(table.insert(), new)
+        if updates:
+            # Missing values in the sheet don't overwrite existing ones
+            material = func.coalesce(bindparam('_material'), table.c.material)
+            location = func.coalesce(bindparam('_location', type_=table.c.location.type),
+                                     table.c.location)
+            # Unchanged samples aren't rewritten, which would e.g.
+            # invalidate cached map tiles
+            stmt = (table.update()
+                .where(table.c.id == bindparam('_id'))
+                .where(or_(
+                    material.is_distinct_from(table.c.material),
+                    func.ST_AsEWKB(location).is_distinct_from(func.ST_AsEWKB(table.c.location))))
+                .values(material=material, location=location))
+            self.db.session.execute(stmt, updates)
+
+        ids = self.sample_ids([row['name'] for row in rows])
+        links = {(ids[row['name']], self.geo_entity(u))
+                 for row in rows for u in row['units']}
+        if not links:
+            return
+        link = self.m.sample_geo_entity.__table__
+        q = (select([link.c.sample_id, link.c.geo_entity_id])
+            .where(link.c.sample_id.in_(list(ids.values()))))
+        links -= {tuple(r) for r in self.db.session.execute(q)}
+        if links:
+            self.db.session.execute(link.insert(), [
+                dict(sample_id=s, geo_entity_id=g) for s, g in links])
@@ -1,14 +1,46 @@
+import json
+from sys import exit
 from os import environ, listdir, path
-from click import command, option, echo, secho, style, Group
+from click import group, option, echo, secho, style, pass_context, pass_obj
+from click import Path as PathType
 from pathlib import Path
-from sparrow import Database
-from sparrow.util import relative_path
-from sparrow import construct_app
 
-from .importer import MAPImporter
-from .metadata import MetadataImporter
+# Sparrow, pandas and the importers are imported inside the commands
+# that use them, so that `--help` and argument errors return quickly.
+from .profiling import ImportProfiler, set_profiler, stage
 
-cli = Group()
+
+class PipelineContext(object):
+    """
+    State shared by chained subcommands, so that e.g.
+    `import-metadata import-map` constructs the app only once.
+    """
+    def __init__(self):
+        self.app = None
+        self.db = None
+        # Whether data has been imported by any subcommand
+        self.imported = False
+
+    @property
+    def database(self):
+        if self.db is None:
+            from sparrow import construct_app
+            self.app, self.db = construct_app(minimal=True)
+        return self.db
+
+    def close(self):
+        if self.imported:
+            refresh_metrics(self.db)
+
+
+@group(chain=True)
+@pass_context
+def cli(ctx):
+    """
+    Import WiscAr data into Sparrow. Subcommands can be chained.
+    """
+    obj = ctx.ensure_object(PipelineContext)
+    ctx.call_on_close(obj.close)
 
 
 def get_data_directory():
@@ -24,31 +56,233 @@ def get_data_directory():
     return p
 
 
+def start_profiler(profile=None, cprofile=None, telemetry=False):
+    # Telemetry records timings from the profiler, without a report
+    report = profile is not None or cprofile is not None
+    if not report and not telemetry:
+        return None
+    out_dir = Path(profile).parent if profile is not None else Path(".")
+    # Records of files are only needed for the report
+    profiler = ImportProfiler(cprofile=cprofile, cprofile_dir=out_dir, keep_files=report)
+    set_profiler(profiler)
+    return profiler
+
+
+def finish_profiler(profiler, profile=None, cprofile=None):
+    if profiler is None:
+        return
+    if profile is not None or cprofile is not None:
+        profiler.print_summary()
+    if profile is not None:
+        profiler.write_report(profile)
+    set_profiler(None)
+
+
+def start_telemetry(db, importer, **options):
+    from .telemetry import ImportTelemetry
+    return ImportTelemetry(db, importer, options).start()
+
+
+def refresh_metrics(db):
+    """
+    Refresh the summary served by the `metrics` backend plugin, if the
+    plugin has created it in this database. The view's unique index
+    lets it be refreshed without blocking readers.
+    """
+    from sqlalchemy import text
+    view = db.session.execute(text("SELECT to_regclass('wiscar_metrics')")).scalar()
+    if view is None:
+        return
+    with stage("refresh_metrics"):
+        db.session.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY wiscar_metrics"))
+        db.session.commit()
+
+
+def watch_map(importer, watcher, refresh_interval=300, **kwargs):
+    """
+    Import files reported by `watcher`, in batches, until interrupted.
+    New sessions are normalized as they are inserted, so only the
+    metrics view needs refreshing. It is refreshed at most every
+    `refresh_interval` seconds, since each refresh summarizes the
+    whole database.
+    """
+    from time import monotonic
+
+    secho(f"Watching {watcher.directory} for new files ({watcher.method})", dim=True)
+    # Include the files imported before watching started
+    refresh_metrics(importer.db)
+    last_refresh = monotonic()
+    stale = False
+    try:
+        for batch in watcher.batches(idle=True):
+            if batch:
+                echo(f"Importing {len(batch)} new file(s)")
+                importer.iterfiles(batch, **kwargs)
+                importer.release()
+                if importer.telemetry is not None:
+                    importer.telemetry.flush()
+                stale = True
+            if stale and monotonic()-last_refresh >= refresh_interval:
+                refresh_metrics(importer.db)
+                last_refresh = monotonic()
+                stale = False
+    except KeyboardInterrupt:
+        secho("Stopped watching", dim=True)
+
+
+profile_option = option('--profile', type=str, default=None,
+    help="Write timings for each file and stage to a JSON or CSV report")
+cprofile_option = option('--cprofile', type=str, default=None,
+    help="Name of a single file to run under cProfile")
+telemetry_option = option('--telemetry/--no-telemetry', default=True,
+    help="Record timings, row counts and errors for each file in the database")
+
+
 @cli.command(name="import-map")
 @option('--redo', '-r', is_flag=True, default=False)
 @option('--stop-on-error', is_flag=True, default=False)
 @option('--verbose', '-v', is_flag=True, default=False)
 @option('--show-data', '-S', is_flag=True, default=False)
-def import_map(redo=False, stop_on_error=False, verbose=False, show_data=False):
+@option('--jobs', '-j', type=int, default=1,
+        help="Number of processes used to parse files")
+@option('--manifest/--no-manifest', default=True,
+        help="Skip files that are unchanged since the last import")
+@option('--table-cache/--no-table-cache', default=True,
+        help="Reuse tables parsed from unchanged files in earlier runs")
+@option('--bulk', is_flag=True, default=False,
+        help="Write heating steps with multi-row inserts")
+@option('--commit-every', type=int, default=25,
+        help="Commit and release ORM objects after this many files")
+@option('--max-memory', type=int, default=None,
+        help="Also release ORM objects when resident memory exceeds this many MB")
+@option('--full-cleanup', is_flag=True, default=False,
+        help="Normalize materials and accepted ages across the whole database")
+@option('--watch', is_flag=True, default=False,
+        help="Keep running, and import new files as they are added")
+@option('--settle', type=float, default=2.0,
+        help="Seconds a new file must be unchanged before it is imported in watch mode")
+@profile_option
+@cprofile_option
+@telemetry_option
+@pass_obj
+def import_map(pipeline, redo=False, stop_on_error=False, verbose=False, show_data=False, jobs=1, manifest=True, table_cache=True, bulk=False,
+               commit_every=25, max_memory=None,
+               full_cleanup=False, watch=False, settle=2.0, profile=None, cprofile=None, telemetry=True):
     """
     Import WiscAr MAP spectrometer data (ArArCalc files) in bulk.
+
+    With `--watch`, files added to the data directory once the initial
+    import has started are imported as they arrive, until interrupted.
     """
     data_path = get_data_directory()/"MAP-Irradiations"
 
-    app, db = construct_app(minimal=True)
-    importer = MAPImporter(db, verbose=verbose, show_data=show_data)
-    importer.iterfiles(data_path.glob("**/*.xls"), redo=redo)
+    from .importer import MAPImporter
+    from .manifest import ImportManifest
+    from .table_cache import TableCache
+
+    profiler = start_profiler(profile, cprofile, telemetry)
+
+    db = pipeline.database
+    if manifest:
+        manifest = ImportManifest.default("map-import")
+    else:
+        manifest = None
+    table_cache = TableCache() if table_cache else None
+    if telemetry:
+        telemetry = start_telemetry(db, "import-map", redo=redo, jobs=jobs, bulk=bulk,
+                                    manifest=manifest is not None)
+    else:
+        telemetry = None
+    importer = MAPImporter(db, verbose=verbose, show_data=show_data,
+                           manifest=manifest, table_cache=table_cache, bulk=bulk,
+                           telemetry=telemetry)
+    watcher = None
+    if watch:
+        from .watch import FileWatcher
+        # Started before the initial import, so that files which arrive
+        # while it runs are picked up afterwards
+        watcher = FileWatcher(data_path, settle=settle).start()
+    try:
+        importer.iterfiles(data_path.glob("**/*.xls"), redo=redo, jobs=jobs,
+                           commit_every=commit_every, max_memory=max_memory)
+        removed = importer.prune_table_cache()
+        if verbose and removed:
+            secho(f"Removed {removed} stale entries from the table cache", dim=True)
+        if watcher is not None:
+            watch_map(importer, watcher, jobs=jobs,
+                      commit_every=commit_every, max_memory=max_memory)
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if telemetry is not None:
+            telemetry.finish()
+    if verbose:
+        importer.vocabulary.report()
+
+    # Newly imported data is normalized as it is inserted, so the
+    # database-wide cleanup is only needed for older imports
+    if full_cleanup:
+        from sparrow.util import relative_path
+        fp = relative_path(__file__, "sql", "clean-data.sql")
+        with stage("clean_data"):
+            db.exec_sql(fp)
 
-    # Clean up data inconsistencies
-    fp = relative_path(__file__, "sql", "clean-data.sql")
-    db.exec_sql(fp)
+    pipeline.imported = True
+    finish_profiler(profiler, profile, cprofile)
+
+
+# Paths are given with a repeatable option rather than a variadic
+# argument, which would take the rest of a chained command line
+@cli.command(name="validate-map")
+@option('--path', '-p', 'paths', multiple=True, type=PathType(exists=True),
+        help="File or directory to check (can be repeated)")
+@option('--jobs', '-j', type=int, default=None,
+        help="Number of processes (default: one per CPU)")
+@option('--report', type=str, default=None,
+        help="Write the report for each file to a JSON file")
+def validate_map(paths, jobs=None, report=None):
+    """
+    Check that ArArCALC files parse and can be transformed for import,
+    without connecting to the database. Checks the files or directories
+    given with `--path`, or the whole MAP archive by default.
+    """
+    from .validate import validate_files, print_report
+
+    if not paths:
+        paths = [get_data_directory()/"MAP-Irradiations"]
+    files = []
+    for p in map(Path, paths):
+        files += sorted(p.glob("**/*.xls")) if p.is_dir() else [p]
+
+    reports = []
+    for res in validate_files(files, jobs=jobs):
+        print_report(res)
+        reports.append(res)
+
+    n_failed = sum(1 for r in reports if not r['ok'])
+    elapsed = sum(r['elapsed'] for r in reports)
+    color = 'red' if n_failed else 'green'
+    secho(f"{len(reports)-n_failed} of {len(reports)} files valid "
+          f"({elapsed:.1f} s parsing)", fg=color, bold=True)
+    if report is not None:
+        with open(report, "w") as f:
+            json.dump(reports, f, indent=2)
+    if n_failed:
+        exit(1)
 
 
 @cli.command(name="import-metadata")
 @option('--redo', '-r', is_flag=True, default=False)
 @option('--stop-on-error', is_flag=True, default=False)
 @option('--verbose', '-v', is_flag=True, default=False)
-def import_metadata(redo=False, stop_on_error=False, verbose=False):
+@option('--bulk', is_flag=True, default=False,
+        help="Upsert samples in batches with multi-row statements")
+@profile_option
+@cprofile_option
+@telemetry_option
+@pass_obj
+def import_metadata(pipeline, redo=False, stop_on_error=False, verbose=False, bulk=False, profile=None, cprofile=None,
+                    telemetry=True):
     """
     Import metadata for measurements.
     """
@@ -57,8 +291,20 @@ def import_metadata(redo=False, stop_on_error=False, verbose=False):
     fn = (data_path/'WiscAr_metadata.xlsx')
     assert fn.exists()
 
-    app, db = construct_app(minimal=True)
-    importer = MetadataImporter(db, fn, verbose=verbose)
+    from .metadata import MetadataImporter
+
+    profiler = start_profiler(profile, cprofile, telemetry)
+
+    db = pipeline.database
+    telemetry = start_telemetry(db, "import-metadata", bulk=bulk) if telemetry else None
+    try:
+        importer = MetadataImporter(db, fn, verbose=verbose, bulk=bulk, telemetry=telemetry)
+    finally:
+        if telemetry is not None:
+            telemetry.finish()
+    pipeline.imported = True
+
+    finish_profiler(profiler, profile, cprofile)
 
 if __name__ == '__main__':
     cli()
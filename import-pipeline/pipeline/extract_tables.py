@@ -1,19 +1,68 @@
 from pandas import read_excel, Series, concat
 import numpy as N
 
+from .sheet_reader import read_sheet_block
+from .profiling import stage
+from .transform import HeatingSteps
+
+# Increment when a change to the parser changes the extracted tables,
+# so that cached tables from earlier versions are not reused
+parser_version = 2
+
+# Labels marking the upper-left corner of each subtable
+anchors = ["Incremental\nHeating", "Information\non Analysis", "Results"]
+
+# Measures of confidence on the plateau fit, in order of preference
+confidence_labels = ["2σ Confidence Limit","1σ Confidence Limit","Statistical T Ratio"]
+
+class CellLocator(object):
+    """
+    Finds the first cell (in row-major order) holding each of a set of
+    label values. All labels requested in a call to `find` are located
+    with a single vectorized mask over the frame, and positions are
+    cached for later lookups.
+    """
+    def __init__(self, df):
+        self.df = df
+        self._positions = {}
+
+    def find(self, *labels):
+        missing = [v for v in labels if v not in self._positions]
+        if missing:
+            for v in missing:
+                self._positions[v] = None
+            mask = self.df.isin(missing).to_numpy()
+            # `nonzero` returns matches in row-major order
+            for i, j in zip(*N.nonzero(mask)):
+                v = self.df.iat[i,j]
+                if self._positions.get(v, False) is None:
+                    self._positions[v] = (int(i), int(j))
+        return {v: self._positions[v] for v in labels}
+
+    def index(self, value, integer=False):
+        ix = self.find(value)[value]
+        if ix is None or integer:
+            return ix
+        i, j = ix
+        return (self.df.index[i], self.df.columns[j])
+
+    def first(self, *labels, integer=False):
+        """Location of the first of `labels` present in the frame"""
+        self.find(*labels)
+        for v in labels:
+            ix = self.index(v, integer=integer)
+            if ix is not None:
+                return v, ix
+        return None, None
+
 def value_index(df, value, integer=False):
-    for i, row in df.iterrows():
-        for j, col in row.iteritems():
-            if col != value: continue
-            if integer:
-                i = df.index.get_loc(i)
-                j = df.columns.get_loc(j)
-            return (i,j)
-
-def extract_results_table(df):
-    ixc = value_index(df, "Results")
-    col = df.columns.get_loc(ixc[1])
-    results = (df.iloc[ixc[0]:,col:]
+    return CellLocator(df).index(value, integer=integer)
+
+def extract_results_table(df, locator=None):
+    if locator is None:
+        locator = CellLocator(df)
+    row, col = locator.index("Results", integer=True)
+    results = (df.iloc[row:,col:]
             .dropna(axis=0, how='all')
             .dropna(axis=1, how='all'))
     results = results.rename(columns=results.iloc[0]).iloc[2:]
@@ -53,9 +102,9 @@ def extract_results_table(df):
 
         # Extract confidence on plateau fit
         # Find the first matching measure of confidence
-        for v in ["2σ Confidence Limit","1σ Confidence Limit","Statistical T Ratio"]:
-            ix = value_index(age_plateau, v, integer=True)
-            if ix is not None: break
+        v, ix = CellLocator(age_plateau).first(*confidence_labels, integer=True)
+        if ix is None:
+            raise ValueError("Could not find confidence measure for age plateau")
         loc = N.index_exp[ix[0]:ix[0]+2,ix[1]-1:ix[1]+1]
         conf = age_plateau.iloc[loc].copy()
         age_plateau.iloc[loc] = N.nan
@@ -91,10 +140,12 @@ def extract_results_table(df):
 
     return results
 
-def extract_incremental_heating_table(df):
+def extract_incremental_heating_table(df, locator=None):
+    if locator is None:
+        locator = CellLocator(df)
     # Get the upper-left index of several subtables
-    ixa = value_index(df, "Incremental\nHeating")
-    ixb = value_index(df, "Information\non Analysis")
+    ixa = locator.index("Incremental\nHeating", integer=True)
+    ixb = locator.index("Information\non Analysis", integer=True)
 
     # Clean the Incremental Heating table
     ih = (df.iloc[ixa[0]:ixb[0],:]
@@ -112,21 +163,16 @@ def extract_incremental_heating_table(df):
     ih.drop(ih.tail(1).index, inplace=True)
 
     ih.set_index(ih.columns[0], inplace=True)
-    ih.columns.name = 'Incremental Heating'
-    ih.index.name = 'Heating Step'
+    return HeatingSteps.from_frame(ih)
 
-    ix = ih['in_plateau'].isnull()
-    ih.loc[~ix,'in_plateau'] = True
-    ih.loc[ix,'in_plateau'] = False
-    return ih
-
-def extract_information_table(df):
+def extract_information_table(df, locator=None):
+    if locator is None:
+        locator = CellLocator(df)
     # Get the upper-left index of several subtables
-    ix = value_index(df, "Information\non Analysis")
+    row, col = locator.index("Information\non Analysis", integer=True)
 
     # Clean Information on Analysis
-    col = df.columns.get_loc(ix[1])
-    info = df.iloc[ix[0]+1:,col:col+1].dropna()
+    info = df.iloc[row+1:,col:col+1].dropna()
     # Expand key/value pairs
     info = info.iloc[:,0].str.split("=", n=1, expand=True)
     info.iloc[:,0] = info.iloc[:,0].str.strip()
@@ -137,19 +183,33 @@ def extract_information_table(df):
     info.columns = ['value']
     return info.loc[:,'value']
 
-def extract_data_tables(fn):
-    # Create a `Pandas` representation of the entire first sheet of the spreadsheet
-    df = read_excel(fn, sheet_name="Incremental Heating Summary")
-    heating = extract_incremental_heating_table(df)
-
-    T = heating['temperature']
-    if (T == T[0]).sum() == len(T):
+def extract_data_tables(fn, streaming=True):
+    sheet_name = "Incremental Heating Summary"
+    with stage("read_excel"):
+        if streaming:
+            # Read only the block of the sheet containing the subtables
+            df = read_sheet_block(fn, sheet_name, anchors)
+        else:
+            # Create a `Pandas` representation of the entire first sheet of the spreadsheet
+            df = read_excel(fn, sheet_name=sheet_name)
+    with stage("extract_tables"):
+        return extract_tables_from_sheet(df)
+
+def extract_tables_from_sheet(df):
+    # Find all subtables in a single pass over the sheet
+    locator = CellLocator(df)
+    locator.find(*anchors)
+
+    heating = extract_incremental_heating_table(df, locator)
+
+    T = heating.value('temperature')
+    if (T == T[0]).all():
         # All the heating steps are at the same temperature
         type = 'Fusion'
     else:
         type = 'Incremental Heating'
 
-    info = extract_information_table(df)
+    info = extract_information_table(df, locator)
     info['Type'] = type
-    results = extract_results_table(df)
+    results = extract_results_table(df, locator)
     return heating, info, results
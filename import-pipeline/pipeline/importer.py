@@ -1,3 +1,4 @@
+import gc
 from sys import exit
 from os import environ, listdir, path
 from datetime import datetime
@@ -5,42 +6,202 @@ from click import command, option, echo, secho, style
 from pathlib import Path
 from sparrow.database import get_or_create
 from sparrow.import_helpers import BaseImporter, SparrowImportError
+from sqlalchemy import select, func, distinct
 
 from .extract_tables import extract_data_tables
+from .parallel import iter_parsed
+from .bulk import HeatingStepWriter
+from .vocabulary import CachedVocabularyMixin
+from .profiling import get_profiler, stage, over_memory
+from .transform import (param_data, material_names, accepted_ages,
+                        heating_step_params, result_columns, split_errors,
+                        ColumnSchema)
 
 def print_dataframe(df):
     secho(str(df.fillna(''))+'\n', dim=True)
 
-param_data = {
-    'Tstep': "Temperature of heating step",
-    'power': "Laser power of heating step",
-    '36Ar(a)': "36Ar, corrected for air interference",
-    '37Ar(ca)': "37Ar, corrected for Ca interference",
-    '38Ar(cl)': "38Ar, corrected for Cl interference",
-    '39Ar(k)': "39Ar, corrected for amount produced by K",
-    '40Ar(r)': "Radiogenic 40Ar measured abundance",
-    '40(r)/39(k)': "Ratio of radiogenic 40Ar to 39Ar from K",
-    'step_age': "Age calculated for a single heating step",
-    'plateau_age': "Age calculated for a plateau",
-    'total_fusion_age': "Age calculated for fusion of all heating steps",
-    '40Ar(r) [%]': "Radiogenic 40Ar, percent released in this step",
-    '39Ar(k) [%]': "39Ar from potassium, percent released in this step",
-    'K/Ca': "Potassium/Calcium ratio"
-}
-
-def split_error(v):
-    a = v.replace("Ma","").split("±")
-    value = float(a[0].strip())
-    error = float(a[1].strip())
-    return value, error
-
-class MAPImporter(BaseImporter):
+class MAPImporter(CachedVocabularyMixin, BaseImporter):
     authority = "WiscAr"
     file_type = "ArArCALC"
     def __init__(self, db, **kwargs):
         self.show_data = kwargs.pop('show_data', False)
+        self.manifest = kwargs.pop('manifest', None)
+        # Cache of tables extracted from previously-parsed files
+        self.table_cache = kwargs.pop('table_cache', None)
+        # Per-file records of timings, row counts and errors
+        self.telemetry = kwargs.pop('telemetry', None)
+        bulk = kwargs.pop('bulk', False)
+        # Parse job for the file currently being imported, if
+        # tables are being extracted in worker processes
+        self._parse_job = None
+        # Sessions created from the file currently being imported
+        self._imported = None
         super().__init__(db, **kwargs)
         self.create_parameters()
+        # Write heating steps with multi-row statements
+        self.heating_step_writer = None
+        if bulk:
+            self.heating_step_writer = HeatingStepWriter(self)
+
+    def iterfiles(self, file_sequence, jobs=1, redo=False, commit_every=25,
+                  max_memory=None, **kwargs):
+        """
+        Import a sequence of files as a pipeline of generators
+        (discover → parse → import), so that only a bounded number of
+        files is in memory at any time. If `jobs` is greater than one,
+        Excel parsing runs in a pool of worker processes while this
+        process imports the parsed tables into the database, in
+        the original file order.
+
+        If the importer has a manifest, files that are unchanged since
+        they were last imported are skipped without being opened.
+
+        Every `commit_every` files, or whenever resident memory exceeds
+        `max_memory` megabytes, the session is committed and all ORM
+        objects are released (see `release`).
+        """
+        manifest = self.manifest
+        profiler = get_profiler()
+
+        parsed = self.parse(self.discover(file_sequence, redo=redo), jobs=jobs)
+
+        try:
+            for i, (fn, job) in enumerate(parsed, 1):
+                self._parse_job = job
+                self._imported = None
+                try:
+                    with profiler.file(fn) as record:
+                        super().iterfiles([fn], redo=redo, **kwargs)
+                finally:
+                    self._parse_job = None
+                if self.telemetry is not None and record is not None:
+                    self.record_telemetry(record)
+                if manifest is not None:
+                    self.update_manifest(fn)
+                if i % commit_every == 0 or over_memory(max_memory):
+                    self.release()
+        finally:
+            if manifest is not None:
+                manifest.save()
+
+    def discover(self, file_sequence, redo=False):
+        """Filter a sequence of files down to those that need importing"""
+        manifest = self.manifest
+        if manifest is not None:
+            manifest.restrict(self.imported_hashes())
+            if not redo:
+                file_sequence = manifest.changed(file_sequence)
+        return file_sequence
+
+    def parse(self, file_sequence, jobs=1):
+        """
+        Yield `(fn, job)` pairs, where `job` is a future for the
+        tables of the file being parsed in a worker process, or `None`
+        if the file will be parsed in this process on import.
+        """
+        if jobs <= 1:
+            return ((fn, None) for fn in file_sequence)
+        cache_dir = None
+        if self.table_cache is not None:
+            cache_dir = self.table_cache.directory
+        return iter_parsed(file_sequence, jobs=jobs,
+                           profile=get_profiler().enabled, cache_dir=cache_dir)
+
+    def release(self):
+        """
+        Commit the session and detach all of its objects, so that the
+        ORM objects and tables of imported files can be freed. Cached
+        vocabulary objects are detached too, so they are dropped from
+        the cache, but the type IDs used by the bulk writers are kept.
+        """
+        with stage("release"):
+            self.db.session.commit()
+            self.db.session.expunge_all()
+            self.vocabulary.expunge()
+            if self.manifest is not None:
+                # Keep progress if a long import is interrupted
+                self.manifest.save()
+            gc.collect()
+
+    def prune_table_cache(self):
+        """
+        Delete cached tables from other parser versions and, if there is
+        a manifest, those of files that are no longer in it. Returns
+        the number of entries removed.
+        """
+        if self.table_cache is None:
+            return 0
+        keep = None
+        if self.manifest is not None:
+            keep = {entry['hash'] for entry in self.manifest.entries.values()}
+        with stage("prune_table_cache"):
+            return self.table_cache.prune(keep)
+
+    def imported_hashes(self):
+        q = self.db.session.query(self.m.data_file.file_hash)
+        return (h for (h,) in q)
+
+    def record_telemetry(self, record):
+        res = self._imported
+        if res is None:
+            # The file was already present in the database
+            self.telemetry.record(record, counts=dict(skipped=1))
+            return
+        self.telemetry.record(record,
+            counts=self.imported_counts(res['sessions']),
+            error=res['error'])
+
+    def imported_counts(self, session_ids):
+        counts = dict(sessions=len(session_ids), analyses=0, datums=0)
+        if not session_ids:
+            return counts
+        analysis = self.m.analysis.__table__
+        datum = self.m.datum.__table__
+        q = (select([func.count(distinct(analysis.c.id)), func.count(datum.c.id)])
+            .select_from(analysis.outerjoin(datum, datum.c.analysis == analysis.c.id))
+            .where(analysis.c.session_id.in_(session_ids)))
+        counts['analyses'], counts['datums'] = self.db.session.execute(q).fetchone()
+        return counts
+
+    def update_manifest(self, fn):
+        res = self._imported
+        if res is None:
+            # The file was already present in the database
+            self.manifest.record(fn)
+        elif len(res['sessions']) > 0:
+            self.manifest.record(fn,
+                session_date=res['date'],
+                sessions=res['sessions'])
+        # Files that failed to import are left out of the manifest
+        # so they are retried on the next run
+
+    def session_date(self, fn):
+        """
+        File modification time is right now the best proxy for
+        creation date. If the file has been imported before, the
+        date recorded in the manifest is reused so that changed
+        files are re-imported into their existing session.
+        """
+        if self.manifest is not None:
+            date = self.manifest.session_date(fn)
+            if date is not None:
+                return date
+        return datetime.fromtimestamp(path.getmtime(fn))
+
+    def extract_tables(self, fn):
+        job = self._parse_job
+        if job is None:
+            if self.table_cache is None:
+                return extract_data_tables(fn)
+            hash = None
+            if self.manifest is not None:
+                hash = self.manifest.hash(fn)
+            return self.table_cache.extract(fn, hash=hash)
+        # Re-raises any exception from the worker process
+        with stage("parse_wait"):
+            tables, stages = job.result()
+        get_profiler().add_stages(stages)
+        return tables
 
     def irradiation(self, id):
         irr = self.db.get_or_create(self.m.irradiation,
@@ -70,27 +231,69 @@ class MAPImporter(BaseImporter):
         """
         Import an original data file
         """
-        # Extract data tables from Excel sheet
-
-        # File modification time is right now the best proxy
-        # for creation date (note: sessions will be duplicated
-        # if input files are changed)
-        mod_time = datetime.fromtimestamp(path.getmtime(fn))
+        # Note: without a manifest, sessions will be duplicated
+        # if input files are changed
+        mod_time = self.session_date(fn)
+        self._imported = dict(date=mod_time, sessions=[], error=None)
+        try:
+            yield from self.import_tables(fn, mod_time)
+        except Exception as exc:
+            # Kept for telemetry, since the error may be handled by
+            # the base importer
+            self._imported['error'] = exc.__cause__ or exc
+            raise
 
+    def import_tables(self, fn, mod_time):
+        # Extract data tables from Excel sheet
         try:
-            incremental_heating, info, results = extract_data_tables(fn)
+            incremental_heating, info, results = self.extract_tables(fn)
         except Exception as exc:
-            raise SparrowImportError(str(exc))
+            raise SparrowImportError(str(exc)) from exc
         if self.show_data:
-            print_dataframe(incremental_heating)
+            print_dataframe(incremental_heating.to_frame())
             print_dataframe(info)
             print_dataframe(results.transpose())
 
+        with stage("session"):
+            session = self.import_session(info, mod_time)
+
+        with stage("general_info"):
+            info = self.general_info(session, info)
+            session.data = info.to_dict()
+
+        with stage("heating_steps"):
+            fields = self.heating_step_fields(incremental_heating)
+            if self.heating_step_writer is not None:
+                self.heating_step_writer.write(session, incremental_heating, fields)
+            else:
+                for i in range(len(incremental_heating)):
+                    self.import_heating_step(i, incremental_heating, session, fields)
+
+        with stage("results"):
+            # Import results table, reading all values and errors at once
+            schema = ColumnSchema(results.columns, result_columns)
+            measured = schema.measurements(results,
+                rows=["Age Plateau", "Total Fusion Age"])
+            try:
+                res = results.loc["Age Plateau"]
+                self.import_age_plateau(session, res, schema, measured)
+            except KeyError:
+                pass
+
+            res = results.loc["Total Fusion Age"]
+            self.import_fusion_age(session, res, schema, measured)
+
+            # This function returns the top-level
+            # record that should be linked to the datafile
+            self.db.session.flush()
+        self._imported['sessions'].append(session.id)
+        yield session
+
+    def import_session(self, info, mod_time):
         sample = self.sample(name=info.pop('Sample'))
-        target = self.material(info.pop('Material'))
-        instrument = self.db.get_or_create(
-            self.m.instrument,
-            name="MAP 215-50")
+        material = info.pop('Material')
+        target = self.material(material_names.get(material, material))
+        instrument = self.instrument("MAP 215-50")
         method = self.method("Ar/Ar "+info.pop("Type"))
         self.add(sample, target, instrument, method)
         self.db.session.flush()
@@ -105,34 +308,15 @@ class MAPImporter(BaseImporter):
         session.date_precision = "day"
         self.add(session)
         self.db.session.flush()
-
-
-        info = self.general_info(session, info)
-        session.data = info.to_dict()
-
-        for i, step in enumerate(incremental_heating.iterrows()):
-            self.import_heating_step(i, step, session, incremental_heating)
-
-        # Import results table
-        try:
-            res = results.loc["Age Plateau"]
-            self.import_age_plateau(session, res)
-        except KeyError:
-            pass
-
-        res = results.loc["Total Fusion Age"]
-        self.import_fusion_age(session, res)
-
-        # This function returns the top-level
-        # record that should be linked to the datafile
-        self.db.session.flush()
-        yield session
+        return session
 
     def general_info(self, session, info):
         analysis = self.add_analysis(session, "General information")
         self.attribute(analysis, "Irradiation ID", info.pop('Project'))
-        # J-value
-        value, error = split_error(info.pop('J'))
+        # J-value and standard ages, which are given as "value ± error"
+        measured = split_errors(info.reindex(['J', 'FC', 'AC']).dropna())
+        info.pop('J')
+        value, error = measured.loc['J']
         self.datum(analysis, "J-value", value, error=error)
         # Location
         self.attribute(analysis, "Irradiation location", info.pop('Location'))
@@ -142,11 +326,10 @@ class MAPImporter(BaseImporter):
 
         # FC or AC tuff age
         for c in ['FC', 'AC']:
-            try:
-                std = info.pop(c)
-            except KeyError:
+            if c not in measured.index:
                 continue
-            value, error = split_error(std)
+            info.pop(c)
+            value, error = measured.loc[c]
             # Correct inconsistencies in our method
             if value > 28 and value < 29:
                 c = 'FC'
@@ -161,67 +344,68 @@ class MAPImporter(BaseImporter):
         self.db.session.flush()
         return info
 
-    def import_heating_step(self, i, step, session, incremental_heating):
-        (ix, row) = step
-
-        analysis = self.add_analysis(session, "Heating step",
-            analysis_name=ix,
-            session_index=i)
-        analysis.in_plateau = row['in_plateau']
-        analysis.is_interpreted = False
-        self.add(analysis)
-
+    def heating_step_fields(self, incremental_heating):
+        """
+        Datums recorded for each heating step, as tuples of
+        (column, whether the column has errors, parameter, datum type options)
+        """
+        fields = []
         # Heuristic to check whether we are measuring
         # laser power or temperature
-        s = incremental_heating['temperature']
-        if (s<=100).sum() == len(s):
+        s = incremental_heating.value('temperature')
+        if (s<=100).all():
             # Everything is less than 100
-            self.datum(analysis, 'power', row['temperature'], unit='%',
-                description='Laser power for heating step')
-
+            fields.append(('temperature', False, 'power', dict(unit='%',
+                description='Laser power for heating step')))
         else:
-            self.datum(analysis, 'Tstep', row['temperature'],
-                unit="°C", description='Temperature of heating step')
+            fields.append(('temperature', False, 'Tstep', dict(unit="°C",
+                description='Temperature of heating step')))
 
-        for param in ['36Ar(a)','37Ar(ca)','38Ar(cl)','39Ar(k)',
-                  '40Ar(r)','39Ar(k) [%]','40Ar(r) [%]']:
+        for param in heating_step_params:
             unit = 'V'
             if '[%]' in param:
                 unit = '%'
-            self.datum(analysis, param, row[param],
-                unit=unit, description=param_data[param])
+            fields.append((param, False, param, dict(unit=unit,
+                description=param_data[param])))
 
-        ix = list(row.index).index('Age')
-        error_ix = ix+1
-        em = self.get_error_metric(row.index[error_ix])
-        self.datum(analysis, 'step_age', row['Age'],
-            unit='Ma',
-            error=row.iloc[error_ix],
-            error_metric=em,
-            error_unit='Ma')
+        for col, param, unit in [('Age', 'step_age', 'Ma'), ('K/Ca', 'K/Ca', 'ratio')]:
+            em = incremental_heating.error_metrics[col]
+            fields.append((col, True, param, dict(unit=unit,
+                error_metric=em,
+                error_unit=unit)))
+        return fields
 
-        self.add_K_Ca_ratio(analysis, row)
-        self.db.session.flush()
+    def import_heating_step(self, i, heating, session, fields):
+        analysis = self.add_analysis(session, "Heating step",
+            analysis_name=heating.steps[i],
+            session_index=i)
+        analysis.in_plateau = bool(heating.in_plateau[i])
+        analysis.is_interpreted = False
+        self.add(analysis)
 
-    def get_error_metric(self, label):
-        return label.replace("± ","")
+        values, errors = heating.step(i)
+        for column, has_error, param, kwargs in fields:
+            if has_error:
+                kwargs = dict(kwargs, error=errors[column])
+            self.datum(analysis, param, values[column], **kwargs)
+
+        self.db.session.flush()
 
-    def add_K_Ca_ratio(self, analysis, row):
-        ix = list(row.index).index('K/Ca')
-        error_ix = ix+1
-        em = self.get_error_metric(row.index[error_ix])
-        self.datum(analysis, 'K/Ca', row['K/Ca'],
+    def add_K_Ca_ratio(self, analysis, label, schema, measured):
+        values, errors = measured
+        self.datum(analysis, 'K/Ca', values.at[label, 'K/Ca'],
             unit='ratio',
-            error=row.iloc[error_ix],
-            error_metric=em,
+            error=errors.at[label, 'K/Ca'],
+            error_metric=schema.error_metric('K/Ca'),
             error_unit='ratio')
 
-    def import_age_plateau(self, session, row):
+    def import_age_plateau(self, session, row, schema, measured):
         analysis = self.analysis(
             session_id = session.id,
             is_interpreted=True,
             type='Age Plateau')
-        row = self.import_shared_parameters(analysis, row)
+        row = self.import_shared_parameters(analysis, row, schema, measured,
+            accepted=self.is_accepted_age(session, 'Age Plateau'))
 
         parameter = self.parameter('39Ar(k) plateau [%]')
         parameter.description="39Ar from potassium, cumulative percent released in all plateau steps"
@@ -235,26 +419,39 @@ class MAPImporter(BaseImporter):
         analysis.data = row.dropna().to_dict()
         self.add(analysis)
 
-    def import_fusion_age(self, session, row):
+    def import_fusion_age(self, session, row, schema, measured):
 
         analysis = self.analysis(
             session_id = session.id,
             is_interpreted=True,
             type='Total Fusion Age')
-        row = self.import_shared_parameters(analysis, row)
+        row = self.import_shared_parameters(analysis, row, schema, measured,
+            accepted=self.is_accepted_age(session, 'Total Fusion Age'))
         analysis.data = row.dropna().to_dict()
         self.add(analysis)
 
-    def import_shared_parameters(self, analysis, row, **kwargs):
-        self.add_K_Ca_ratio(analysis, row)
+    def is_accepted_age(self, session, analysis_type):
+        """
+        Plateau ages of incremental heating experiments and total
+        fusion ages of fusion experiments are accepted on import.
+        """
+        return accepted_ages.get(session.technique) == analysis_type
+
+    def import_shared_parameters(self, analysis, row, schema, measured, accepted=False, **kwargs):
+        """
+        Import the ages and ratios shared by plateau and total fusion
+        ages, using values and errors from the results table that have
+        already been converted (see `ColumnSchema.measurements`).
+        """
+        label = row.name
+        values, errors = measured
+        self.add_K_Ca_ratio(analysis, label, schema, measured)
 
         age_parameter = 'plateau_age'
         if analysis.analysis_type == 'Total Fusion Age':
             age_parameter = 'total_fusion_age'
 
-        ix = list(row.index).index('Age')
-        error_ix = ix+1
-        em = self.get_error_metric(row.index[error_ix])
+        em = schema.error_metric('Age')
 
         # TODO: integrate this new method
         # Datum = self.db.app.interface.datum()
@@ -274,26 +471,25 @@ class MAPImporter(BaseImporter):
         #
         # Datum.load(datum, session=self.db.session)
         #
-        self.datum(analysis,
-            value=row['Age'],
+        age = self.datum(analysis,
+            value=values.at[label, 'Age'],
             unit='Ma',
             parameter=age_parameter,
-            error=row.iloc[error_ix],
+            error=errors.at[label, 'Age'],
             error_metric=em,
             is_computed=True,
             error_unit='Ma',
             **kwargs)
+        if accepted:
+            age.is_accepted = True
 
         ## 40Ar/39Ar(k) ratio
         param = '40(r)/39(k)'
-        ix = list(row.index).index(param)
-        error_ix = ix+1
-        el = row.index[error_ix]
-        em = self.get_error_metric(el)
-        self.datum(analysis, param, row[param],
+        el = schema.error_labels[param]
+        self.datum(analysis, param, values.at[label, param],
             unit='ratio',
-            error=row.iloc[error_ix],
-            error_metric=em,
+            error=errors.at[label, param],
+            error_metric=schema.error_metric(param),
             is_interpreted=True,
             is_computed=True,
             error_unit='ratio')
@@ -0,0 +1,113 @@
+import json
+from os import environ, replace
+from datetime import datetime
+from hashlib import md5
+from pathlib import Path
+
+
+def get_cache_directory():
+    env = environ.get("SPARROW_IMPORT_CACHE_DIR", None)
+    if env is None:
+        return Path.home()/".cache"/"sparrow-wiscar"
+    return Path(env)
+
+
+def file_hash(fn, chunk_size=1 << 20):
+    """MD5 hash of a file's contents, matching Sparrow's data file hashes"""
+    h = md5()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ImportManifest(object):
+    """
+    A persistent record of the files that have been imported, keyed by
+    path, with each file's size, modification time and content hash.
+
+    Files whose size and modification time are unchanged are skipped
+    without being read. Files that have been touched but not modified
+    are detected by their hash. Each entry also keeps the date of the
+    analytical session created from the file, so that a modified file
+    is re-imported into its existing session rather than a new one.
+    """
+    version = 1
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self._hashes = {}
+        if self.path.exists():
+            with self.path.open() as f:
+                data = json.load(f)
+            if data.get("version") == self.version:
+                self.entries = data["files"]
+
+    @classmethod
+    def default(cls, name="map-import"):
+        return cls(get_cache_directory()/f"{name}-manifest.json")
+
+    def key(self, fn):
+        return str(Path(fn).resolve())
+
+    def hash(self, fn):
+        # Hashes are memoized for the current state of the file
+        st = Path(fn).stat()
+        k = (self.key(fn), st.st_size, st.st_mtime)
+        if k not in self._hashes:
+            self._hashes[k] = file_hash(fn)
+        return self._hashes[k]
+
+    def restrict(self, known_hashes):
+        """
+        Forget entries for files whose hash is not present in the
+        database (e.g. after a database reset).
+        """
+        known_hashes = set(known_hashes)
+        self.entries = {k: v for k, v in self.entries.items()
+                        if v['hash'] in known_hashes}
+
+    def is_current(self, fn):
+        entry = self.entries.get(self.key(fn))
+        if entry is None:
+            return False
+        st = Path(fn).stat()
+        if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return True
+        if entry['hash'] != self.hash(fn):
+            return False
+        # File was touched but its contents are the same
+        entry.update(size=st.st_size, mtime=st.st_mtime)
+        return True
+
+    def changed(self, file_sequence):
+        """Yield only files that are new or have been modified"""
+        for fn in file_sequence:
+            if not self.is_current(fn):
+                yield fn
+
+    def session_date(self, fn):
+        entry = self.entries.get(self.key(fn))
+        if entry is None or entry.get('session_date') is None:
+            return None
+        return datetime.fromisoformat(entry['session_date'])
+
+    def record(self, fn, session_date=None, sessions=None):
+        k = self.key(fn)
+        st = Path(fn).stat()
+        entry = self.entries.get(k, {})
+        if session_date is not None:
+            entry['session_date'] = session_date.isoformat()
+        if sessions is not None:
+            entry['sessions'] = sessions
+        entry.update(size=st.st_size, mtime=st.st_mtime, hash=self.hash(fn))
+        self.entries[k] = entry
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as f:
+            json.dump(dict(version=self.version, files=self.entries), f, indent=1)
+        # Atomic replacement so an interrupted run can't corrupt the manifest
+        replace(tmp, self.path)
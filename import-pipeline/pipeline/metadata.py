@@ -6,7 +6,41 @@ from click import command, option, echo, secho, style
 from pathlib import Path
 from sparrow.database import get_or_create
 from sparrow.import_helpers import BaseImporter, SparrowImportError
-from pandas import read_excel, isna
+from sqlalchemy import select, literal, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from pandas import ExcelFile, concat, isna
+
+from .bulk import SampleWriter
+from .vocabulary import CachedVocabularyMixin
+from .profiling import get_profiler, stage
+
+# Columns of the metadata sheets that are used by the importer
+columns = {
+    'sample_name': str,
+    'Irradiation': str,
+    'longitude': float,
+    'latitude': float,
+    'lithology': str,
+    'Formation': str,
+    'Member': str,
+    'Title': str,
+    'doi_link': str,
+    'author': str,
+    'journal': str,
+    'year': None,
+}
+
+def read_metadata(fn, sheets=(0, 1)):
+    """
+    Read the used columns of the metadata sheets into one data frame,
+    opening the workbook only once.
+    """
+    dtypes = {k: v for k, v in columns.items() if v is not None}
+    with ExcelFile(fn) as xl:
+        frames = [xl.parse(sheet, usecols=lambda c: c in columns, dtype=dtypes)
+                  for sheet in sheets]
+    return concat(frames, ignore_index=True)
 
 def print_dataframe(df):
     secho(str(df.fillna('—'))+'\n', dim=True)
@@ -32,13 +66,40 @@ def check_matching_irradiation(sample, row):
         return
 
     irr = session.get_attribute("Irradiation ID")
+    v = check_irradiation([a.value for a in irr], row)
+    print(f"  Irradiation {v}")
+
+def check_irradiation(values, row):
+    """
+    Check the "Irradiation ID" values of a sample's first session
+    against the irradiation listed in the metadata sheet.
+    """
     # Sessions should not have two Irradiation IDs
-    assert len(irr) == 1
-    v = irr[0].value
+    assert len(values) == 1
+    v = values[0]
     v1 = str(row['Irradiation'])
     if not v.startswith(v1):
         raise SparrowImportError(f"Irradiation mismatch")
-    print(f"  Irradiation {v}")
+    return v
+
+def geo_units(row):
+    units = []
+    # Formations
+    fm = row.get("Formation")
+    if fm is not None and not isna(fm):
+        units.append({
+            'name': fm,
+            'type': 'formation'
+        })
+
+    # Members (even though most aren't actually members in the sheet)
+    mbr = row.get("Member")
+    if mbr is not None and not isna(mbr):
+        units.append({
+            'name': mbr,
+            'type': 'member (unverified + notes)'
+        })
+    return units
 
 def format_authorlist(author):
     __ = [a.strip() for a in author.replace(';',',').split(",")]
@@ -62,11 +123,17 @@ def parse_doi(link):
         doi = None
     return doi, link
 
-class MetadataImporter(BaseImporter):
+class MetadataImporter(CachedVocabularyMixin, BaseImporter):
     authority = "WiscAr"
     def __init__(self, db, metadata_file, **kwargs):
         super().__init__(db)
         self.verbose = kwargs.pop("verbose", False)
+        # Record of timings, row counts and errors
+        self.telemetry = kwargs.pop("telemetry", None)
+        # Upsert samples in batches rather than one at a time
+        self.sample_writer = None
+        if kwargs.pop("bulk", False):
+            self.sample_writer = SampleWriter(self)
         self.iterfiles([metadata_file])
 
     def import_datafile(self, fn, rec, **kwargs):
@@ -76,15 +143,30 @@ class MetadataImporter(BaseImporter):
         verbose = self.verbose
         # Extract data tables from Excel sheet
 
-        self.import_sheet(fn, 0)
-        self.import_sheet(fn, 1)
-
-    def import_sheet(self, fn, index=0):
-        df = read_excel(fn, sheet_name=index)
-        n = len(df)
-        print(f"{n} rows")
-        self.import_samples(df)
-        self.import_projects(df)
+        record = None
+        counts = {}
+        error = None
+        try:
+            with get_profiler().file(fn) as record:
+                with stage("read_excel"):
+                    df = read_metadata(fn)
+                print(f"{len(df)} rows")
+                counts = dict(rows=len(df),
+                    samples=df.sample_name.nunique(),
+                    projects=df.groupby(["Title", "doi_link"]).ngroups)
+                # Samples listed on both sheets are only imported once
+                with stage("samples"):
+                    self.import_samples(df)
+                with stage("projects"):
+                    self.import_projects(df)
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            if self.telemetry is not None and record is not None:
+                self.telemetry.record(record, counts=counts, error=error)
+        if verbose:
+            self.vocabulary.report()
 
     def import_samples(self, df):
         # Group everything
@@ -94,16 +176,70 @@ class MetadataImporter(BaseImporter):
         # We might not want to assume sample ID uniqueness
         print(f"{len(samples)} unique sample names")
 
+        if self.sample_writer is not None:
+            self.import_samples_bulk(samples)
+            return
+
         # Import individual samples
         for i, row in samples.iterrows():
+            self.import_sample_row(row)
+
+        self.db.session.flush()
+
+    def import_sample_row(self, row):
+        try:
+            self.import_sample(row)
+            self.db.session.commit()
+        except SparrowImportError as exc:
+            secho(exc.__class__.__name__+": "+str(exc), fg='red')
+            self.db.session.rollback()
+
+    def import_samples_bulk(self, samples, batch_size=500):
+        writer = self.sample_writer
+        for start in range(0, len(samples), batch_size):
+            batch = samples.iloc[start:start+batch_size]
+            existing = writer.existing([str(name) for name in batch.index])
+            rows = []
+            for name, row in batch.iterrows():
+                try:
+                    rows.append(self.sample_values(row, existing.get(str(name))))
+                except SparrowImportError as exc:
+                    secho(f"Sample {name}: "+exc.__class__.__name__+": "+str(exc), fg='red')
             try:
-                self.import_sample(row)
+                writer.write(rows, existing)
                 self.db.session.commit()
-            except SparrowImportError as exc:
-                secho(exc.__class__.__name__+": "+str(exc), fg='red')
+                n_new = sum(1 for row in rows if row['name'] not in existing)
+                echo(f"{len(rows)} samples written ({n_new} created)")
+            except SQLAlchemyError as exc:
+                # Find the offending rows by importing this batch one at a time
                 self.db.session.rollback()
+                secho(f"Bulk sample write failed ({exc.__class__.__name__}), "
+                      "retrying samples individually", fg='yellow')
+                for name, row in batch.iterrows():
+                    self.import_sample_row(row)
 
-        self.db.session.flush()
+    def sample_values(self, row, existing=None):
+        """
+        Column values and geological units for a sample, checking its
+        irradiation against the existing sample (if any).
+        """
+        name = str(row.name)
+        if existing is not None and existing['irradiation'] is not None:
+            check_irradiation(existing['irradiation'], row)
+
+        location = None
+        lon = row['longitude']
+        lat = row['latitude']
+        if not (isna(lon) or isna(lat)):
+            location = self.location(lon, lat)
+
+        material = None
+        lith = row['lithology']
+        if not isna(lith):
+            material = self.material(lith).id
+
+        return dict(name=name, material=material, location=location,
+                    units=geo_units(row))
 
     def import_sample(self, row):
         name = str(row.name)
@@ -143,22 +279,7 @@ class MetadataImporter(BaseImporter):
         ## Geological entities
         # NOTE: this should probably happen before sample is added, but we
         # couldn't get that to work using the prototype schema-based importing.
-        units = []
-        # Formations
-        fm = row.get("Formation")
-        if fm is not None and not isna(fm):
-            units.append({
-                'name': fm,
-                'type': 'formation'
-            })
-
-        # Members (even though most aren't actually members in the sheet)
-        mbr = row.get("Member")
-        if mbr is not None and not isna(mbr):
-            units.append({
-                'name': mbr,
-                'type': 'member (unverified + notes)'
-            })
+        units = geo_units(row)
 
         # Build "linking" model and insert
         for u in units:
@@ -199,24 +320,59 @@ class MetadataImporter(BaseImporter):
         pub.author = author
         pub.journal = get('journal')
         pub.year = get('year')
-        p.publication_collection.append(pub)
+        if pub not in p.publication_collection:
+            p.publication_collection.append(pub)
 
+        self.db.session.add(p)
         sample_names = [a for a in group.sample_name.unique().astype(str) if not isna(a)]
         if len(sample_names):
-            # Link sessions to the project
-            q = (self.db.session.query(self.m.session)
-                .join(self.m.sample)
-                .filter(self.m.sample.name.in_(sample_names)))
-            p.session_collection += q
-            # Directly link samples (this produces duplicate links which could be
-            # an issue)
-            q = (self.db.session.query(self.m.sample)
-                .filter(self.m.sample.name.in_(sample_names)))
-            p.sample_collection += q
-
-        self.db.session.add(p)
+            # The project needs an id before it can be linked
+            self.db.session.flush()
+            self.link_project(p, sample_names)
         print("")
 
+    def link_project(self, project, sample_names):
+        """
+        Link a project to the named samples and their sessions, in the
+        database rather than through the ORM collections. Links that
+        already exist are left alone, so re-importing the sheet only
+        writes new links.
+
+        A session belongs to a single project. Sessions of samples that
+        appear under several publications keep the first project they
+        were linked to, and are reported instead of being reassigned,
+        so that the result doesn't depend on how often the sheet has
+        been imported.
+        """
+        sample = self.m.sample.__table__
+        session = self.m.session.__table__
+        names = sample.c.name.in_(sample_names)
+
+        # Directly link samples
+        link = self.m.project.sample_collection.property.secondary
+        q = select([literal(project.id), sample.c.id]).where(names)
+        stmt = (insert(link)
+            .from_select([link.c.project_id, link.c.sample_id], q)
+            .on_conflict_do_nothing())
+        n_samples = self.db.session.execute(stmt).rowcount
+
+        # Link sessions of these samples that don't have a project yet
+        stmt = (session.update()
+            .where(session.c.sample_id == sample.c.id)
+            .where(names)
+            .where(session.c.project_id.is_(None))
+            .values(project_id=project.id))
+        n_sessions = self.db.session.execute(stmt).rowcount
+        echo(f"  linked {n_samples} new samples, {n_sessions} new sessions")
+
+        q = (select([func.count()])
+            .select_from(session.join(sample, session.c.sample_id == sample.c.id))
+            .where(names)
+            .where(session.c.project_id != project.id))
+        n_conflicts = self.db.session.execute(q).scalar()
+        if n_conflicts:
+            secho(f"  {n_conflicts} sessions already belong to another project", fg='yellow')
+
     def import_projects(self, df):
         # Group by publication for now
         projects = df.groupby(["Title", "doi_link"])
@@ -0,0 +1,49 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .extract_tables import extract_data_tables
+from .profiling import ImportProfiler, set_profiler
+from .table_cache import TableCache
+
+
+def parse_file(fn, profile=False, cache_dir=None):
+    """
+    Extract the data tables from a file in a worker process, returning
+    them along with the time taken in each parsing stage.
+
+    If `cache_dir` is given, tables are read from and saved to a
+    `TableCache` in that directory.
+    """
+    extract = extract_data_tables
+    if cache_dir is not None:
+        extract = TableCache(cache_dir).extract
+    if not profile:
+        return extract(fn), {}
+    profiler = ImportProfiler()
+    set_profiler(profiler)
+    try:
+        return extract(fn), profiler.stages
+    finally:
+        set_profiler(None)
+
+
+def iter_parsed(file_sequence, jobs=2, lookahead=None, profile=False, cache_dir=None):
+    """
+    Parse ArArCALC files in a pool of worker processes, yielding
+    `(fn, future)` pairs in the same order as `file_sequence`.
+
+    Only `lookahead` files (by default twice the number of workers)
+    are in flight at any time, so the parsed tables for the whole
+    archive are never held in memory at once. The caller should
+    resolve each future before advancing the generator.
+    """
+    if lookahead is None:
+        lookahead = 2*jobs
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for fn in file_sequence:
+            pending.append((fn, pool.submit(parse_file, fn, profile, cache_dir)))
+            if len(pending) >= lookahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
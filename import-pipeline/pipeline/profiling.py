@@ -0,0 +1,170 @@
+import csv
+import json
+import cProfile
+import resource
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter, process_time
+from click import echo, secho
+
+
+def new_timing():
+    return dict(wall=0.0, cpu=0.0, count=0)
+
+
+def add_timing(totals, name, wall, cpu, count=1):
+    t = totals.setdefault(name, new_timing())
+    t['wall'] += wall
+    t['cpu'] += cpu
+    t['count'] += count
+
+
+def resident_memory():
+    """
+    Current resident memory of this process in MB, or `None` where
+    it can't be read from /proc.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages*resource.getpagesize()/(1 << 20)
+
+
+def over_memory(limit):
+    """Whether resident memory exceeds `limit` MB (if one is set)"""
+    if limit is None:
+        return False
+    rss = resident_memory()
+    return rss is not None and rss > limit
+
+
+class NullProfiler(object):
+    enabled = False
+
+    @contextmanager
+    def file(self, fn):
+        yield
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add_stages(self, stages):
+        pass
+
+
+class ImportProfiler(object):
+    """
+    Records wall and CPU time for each stage of an import, both for
+    the run as a whole and for the file currently being imported.
+
+    Each file's record is kept for reports only if `keep_files` is set,
+    so that memory use doesn't grow with the number of files imported.
+    """
+    enabled = True
+
+    def __init__(self, cprofile=None, cprofile_dir=".", keep_files=True):
+        self.stages = {}
+        self.files = []
+        self.keep_files = keep_files
+        self._current = None
+        # Name of a single file to run under cProfile
+        self.cprofile = cprofile
+        self.cprofile_dir = Path(cprofile_dir)
+
+    def _should_cprofile(self, fn):
+        if self.cprofile is None:
+            return False
+        return Path(fn).name == self.cprofile
+
+    @contextmanager
+    def file(self, fn):
+        record = dict(file=str(fn), wall=0.0, cpu=0.0, stages={})
+        self._current = record
+        profile = None
+        if self._should_cprofile(fn):
+            profile = cProfile.Profile()
+            profile.enable()
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = perf_counter()-wall
+            record['cpu'] = process_time()-cpu
+            if profile is not None:
+                profile.disable()
+                self.cprofile_dir.mkdir(parents=True, exist_ok=True)
+                name = Path(fn).name.replace(" ", "_")
+                out = self.cprofile_dir/(name+".prof")
+                profile.dump_stats(str(out))
+                secho(f"Wrote cProfile stats to {out}", dim=True)
+            self._current = None
+            if self.keep_files:
+                self.files.append(record)
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            self._record(name, perf_counter()-wall, process_time()-cpu)
+
+    def _record(self, name, wall, cpu, count=1):
+        add_timing(self.stages, name, wall, cpu, count)
+        if self._current is not None:
+            add_timing(self._current['stages'], name, wall, cpu, count)
+
+    def add_stages(self, stages):
+        """Merge stage timings measured elsewhere (e.g. in a worker process)"""
+        for name, t in stages.items():
+            self._record(name, t['wall'], t['cpu'], t['count'])
+
+    def write_report(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == '.csv':
+            with path.open('w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['file', 'stage', 'wall', 'cpu', 'count'])
+                for name, t in self.stages.items():
+                    writer.writerow(['', name, t['wall'], t['cpu'], t['count']])
+                for r in self.files:
+                    writer.writerow([r['file'], 'total', r['wall'], r['cpu'], 1])
+                    for name, t in r['stages'].items():
+                        writer.writerow([r['file'], name, t['wall'], t['cpu'], t['count']])
+        else:
+            with path.open('w') as f:
+                json.dump(dict(stages=self.stages, files=self.files), f, indent=2)
+        secho(f"Wrote profile report to {path}", dim=True)
+
+    def print_summary(self, n_slowest=10):
+        secho("Time by stage", bold=True)
+        for name, t in sorted(self.stages.items(), key=lambda v: -v[1]['wall']):
+            echo(f"  {name:<20}{t['wall']:>10.2f} s wall {t['cpu']:>10.2f} s cpu {t['count']:>8}×")
+
+        if not self.files:
+            return
+        secho(f"Slowest files", bold=True)
+        for r in sorted(self.files, key=lambda r: -r['wall'])[:n_slowest]:
+            echo(f"  {r['wall']:>8.2f} s  {r['file']}")
+
+
+# Pipeline code wraps units of work in `stage(name)` blocks, which
+# are no-ops unless a profiler has been activated for the run.
+_profiler = NullProfiler()
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler if profiler is not None else NullProfiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def stage(name):
+    return _profiler.stage(name)
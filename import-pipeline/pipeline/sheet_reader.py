@@ -0,0 +1,137 @@
+from pathlib import Path
+
+from pandas import DataFrame
+import numpy as N
+
+# Strings that `read_excel` interprets as missing values
+na_values = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+             '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a',
+             'nan', 'null'}
+
+
+def convert_value(v):
+    """Convert a cell value in the same way as `read_excel`"""
+    if v is None:
+        return N.nan
+    if isinstance(v, str):
+        if v in na_values:
+            return N.nan
+        return v
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
+
+
+def iter_xls_rows(fn, sheet_name):
+    import xlrd
+    # Loading on demand avoids parsing every sheet in the workbook
+    book = xlrd.open_workbook(fn, on_demand=True)
+    try:
+        sheet = book.sheet_by_name(sheet_name)
+        for i in range(sheet.nrows):
+            row = []
+            for cell in sheet.row(i):
+                v = cell.value
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    v = xlrd.xldate.xldate_as_datetime(v, book.datemode)
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    v = bool(v)
+                elif cell.ctype in (xlrd.XL_CELL_ERROR, xlrd.XL_CELL_EMPTY):
+                    v = None
+                row.append(v)
+            yield row
+    finally:
+        book.release_resources()
+
+
+def iter_xlsx_rows(fn, sheet_name):
+    from openpyxl import load_workbook
+    book = load_workbook(fn, read_only=True, data_only=True)
+    try:
+        for row in book[sheet_name].iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        book.close()
+
+
+def iter_sheet_rows(fn, sheet_name):
+    """
+    Iterate over the cell values in each row of a worksheet, without
+    loading the rest of the workbook. Handles both legacy `.xls` and
+    `.xlsx` files.
+    """
+    if Path(fn).suffix.lower() == '.xls':
+        rows = iter_xls_rows(fn, sheet_name)
+    else:
+        rows = iter_xlsx_rows(fn, sheet_name)
+    for row in rows:
+        yield [convert_value(v) for v in row]
+
+
+def is_empty(v):
+    return isinstance(v, float) and N.isnan(v)
+
+
+def read_sheet_block(fn, sheet_name, anchors):
+    """
+    Read the subtables of a worksheet in a single pass. Each of the
+    `anchors` labels marks the upper-left corner of a subtable, given
+    in sheet order as (first, middle, last):
+
+    - the first subtable spans all columns, down to the row of the
+      second anchor;
+    - the second is the column below its anchor;
+    - the last spans the columns from its anchor rightwards, down to
+      the end of the sheet.
+
+    These are the ranges that the extractors slice from the sheet.
+    Cells outside them are never stored, and rows that are empty
+    within them are skipped, as are trailing empty columns.
+
+    Returns a data frame with a positional index and columns. Each
+    subtable has the same rows and columns, after dropping empty ones,
+    as in the output of `read_excel`.
+    """
+    first, middle, last = anchors
+    # Column of each anchor that has been found
+    found = {}
+    rows = []
+    width = 0
+    # The header row is consumed by `read_excel`, so it is skipped
+    # here as well to match its results.
+    for i, row in enumerate(iter_sheet_rows(fn, sheet_name)):
+        if i == 0:
+            continue
+        for j, v in enumerate(row):
+            if isinstance(v, str) and v in anchors and v not in found:
+                found[v] = j
+        if first not in found:
+            continue
+        if middle in found:
+            # Past the end of the first subtable, keep only the cells
+            # of the other two
+            kept = [N.nan]*len(row)
+            j = found[middle]
+            if j < len(row):
+                kept[j] = row[j]
+            if last in found:
+                j = found[last]
+                kept[j:] = row[j:]
+            row = kept
+        # Track the extent of non-empty cells
+        for j in range(len(row)-1, -1, -1):
+            if not is_empty(row[j]):
+                width = max(width, j+1)
+                break
+        else:
+            # Empty rows are dropped by the extractors anyway
+            continue
+        rows.append(row)
+
+    missing = set(anchors) - set(found)
+    if missing:
+        labels = ", ".join(repr(v) for v in missing)
+        raise ValueError(f"Could not find {labels} in sheet '{sheet_name}'")
+
+    rows = [r[:width] + [N.nan]*(width-len(r)) for r in rows]
+    return DataFrame(rows, dtype=object)
@@ -1,3 +1,8 @@
+/*
+Database-wide cleanup for data imported before materials and accepted
+ages were normalized by `MAPImporter` at insert time. Run with
+`import-map --full-cleanup`.
+*/
 UPDATE session SET
   target = 'groundmass'
 WHERE target = 'gmass';
@@ -14,6 +19,8 @@ a total fusion experiment
 the logic of the import script if we
 want to be able to adjust what is
 considered 'accepted').
+Ages that are already accepted are skipped, so that repeated
+cleanups don't rewrite them.
 */
 UPDATE datum SET
 	is_accepted = true
@@ -29,6 +36,7 @@ JOIN session s
 WHERE analysis_type = 'Total Fusion Age'
   AND technique = 'Ar/Ar Fusion'
   AND parameter = 'total_fusion_age'
+  AND d.is_accepted IS NOT true
 );
 
 /*
@@ -48,4 +56,5 @@ WHERE id IN (
 	WHERE analysis_type = 'Age Plateau'
 	  AND technique = 'Ar/Ar Incremental Heating'
 	  AND parameter = 'plateau_age'
+	  AND d.is_accepted IS NOT true
 );
@@ -0,0 +1,98 @@
+import pickle
+from os import replace, unlink
+from time import time
+from tempfile import NamedTemporaryFile
+from pathlib import Path
+
+from .extract_tables import extract_data_tables, parser_version
+from .manifest import get_cache_directory, file_hash
+from .profiling import stage
+
+
+class TableCache(object):
+    """
+    An on-disk cache of the tables extracted from ArArCALC files, keyed
+    by each file's content hash and the parser version, so that files
+    are only parsed again when they or the parser change.
+
+    Tables are stored with pickle rather than a columnar format: the
+    extracted frames have duplicate column labels (e.g. "± 2σ") and
+    mixed-type object columns, which Parquet and Feather can't hold
+    without reshaping them.
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = get_cache_directory()/"tables"
+        self.directory = Path(directory)
+
+    def path(self, hash):
+        return self.directory/f"{hash}-v{parser_version}.pickle"
+
+    def load(self, hash):
+        fn = self.path(hash)
+        if not fn.exists():
+            return None
+        with stage("cache_load"):
+            try:
+                with fn.open("rb") as f:
+                    return pickle.load(f)
+            except Exception:
+                # Treat an unreadable entry (e.g. truncated, or pickled
+                # from objects that have since changed) as a miss
+                return None
+
+    def save(self, hash, tables):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fn = self.path(hash)
+        with stage("cache_save"):
+            # A unique temporary file, since parallel workers may save
+            # tables of identical files at the same time
+            with NamedTemporaryFile(dir=self.directory, prefix=fn.stem+"-",
+                                    suffix=".tmp", delete=False) as f:
+                try:
+                    pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+                except BaseException:
+                    f.close()
+                    unlink(f.name)
+                    raise
+            replace(f.name, fn)
+
+    def prune(self, keep=None, tmp_age=3600):
+        """
+        Delete entries written by other parser versions and, if `keep`
+        is given, entries for hashes not in it. Temporary files older
+        than `tmp_age` seconds are left over from interrupted saves and
+        are deleted too. Returns the number of files removed.
+        """
+        if not self.directory.exists():
+            return 0
+        suffix = f"-v{parser_version}"
+        removed = 0
+        for fn in self.directory.iterdir():
+            if fn.suffix == ".pickle":
+                hash, _, version = fn.stem.rpartition("-")
+                stale = "-"+version != suffix or (keep is not None and hash not in keep)
+            elif fn.suffix == ".tmp":
+                try:
+                    stale = time()-fn.stat().st_mtime > tmp_age
+                except FileNotFoundError:
+                    continue
+            else:
+                continue
+            if stale:
+                fn.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def extract(self, fn, hash=None):
+        """
+        Extract the data tables from a file, using cached tables if
+        the file has been parsed before.
+        """
+        if hash is None:
+            hash = file_hash(fn)
+        tables = self.load(hash)
+        if tables is None:
+            tables = extract_data_tables(fn)
+            self.save(hash, tables)
+        return tables
@@ -0,0 +1,93 @@
+import json
+from click import secho
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+
+class ImportTelemetry(object):
+    """
+    Writes a record of an import run, and of each file imported in it,
+    to the `import_run` and `import_file` tables (see
+    `sql/import-telemetry.sql`). Timings come from the `ImportProfiler`
+    record of each file.
+
+    Records are written on their own connection, so they are kept even
+    if an import's transaction is rolled back. File records are
+    buffered and written in batches.
+    """
+    # Stages counted as parsing; other stages are database work
+    parse_stages = {'read_excel', 'extract_tables', 'parse_wait', 'cache_load', 'cache_save'}
+
+    def __init__(self, db, importer, options=None, flush_every=50):
+        self.engine = db.engine
+        self.importer = importer
+        self.options = options or {}
+        self.flush_every = flush_every
+        self.run_id = None
+        self.pending = []
+        self.n_files = 0
+        self.n_failed = 0
+
+    @property
+    def enabled(self):
+        return self.run_id is not None
+
+    def start(self):
+        try:
+            with self.engine.begin() as conn:
+                self.run_id = conn.execute(text(
+                    "INSERT INTO import_run (importer, options) "
+                    "VALUES (:importer, CAST(:options AS jsonb)) RETURNING id"),
+                    importer=self.importer, options=json.dumps(self.options)).scalar()
+        except ProgrammingError:
+            secho("Import telemetry tables are missing; run `sparrow init` to create them",
+                  fg='yellow')
+        return self
+
+    def record(self, profile, counts=None, error=None):
+        """
+        Record the import of a file.
+
+        :param profile: the file's record from `ImportProfiler.file`
+        """
+        if not self.enabled:
+            return
+        stages = profile['stages']
+        # With parallel parsing, parse time includes time in worker
+        # processes, which overlaps the file's wall time
+        parse_time = sum(t['wall'] for name, t in stages.items() if name in self.parse_stages)
+        db_time = sum(t['wall'] for name, t in stages.items() if name not in self.parse_stages)
+        self.pending.append(dict(
+            run_id=self.run_id,
+            file=profile['file'],
+            parse_time=parse_time,
+            db_time=db_time,
+            total_time=profile['wall'],
+            counts=json.dumps(counts or {}),
+            error_class=error.__class__.__name__ if error is not None else None,
+            error=str(error)[:1000] if error is not None else None))
+        self.n_files += 1
+        if error is not None:
+            self.n_failed += 1
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "INSERT INTO import_file (run_id, file, parse_time, db_time, total_time, "
+                "counts, error_class, error) VALUES (:run_id, :file, :parse_time, :db_time, "
+                ":total_time, CAST(:counts AS jsonb), :error_class, :error)"), self.pending)
+        self.pending = []
+
+    def finish(self):
+        if not self.enabled:
+            return
+        self.flush()
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "UPDATE import_run SET finished = now(), n_files = :n_files, "
+                "n_failed = :n_failed WHERE id = :id"),
+                n_files=self.n_files, n_failed=self.n_failed, id=self.run_id)
@@ -0,0 +1,150 @@
+"""
+Vocabulary and value transformations for ArArCALC tables that don't
+depend on the database, shared by the importer and `validate-map`.
+"""
+import numpy as N
+from pandas import DataFrame, to_numeric
+
+param_data = {
+    'Tstep': "Temperature of heating step",
+    'power': "Laser power of heating step",
+    '36Ar(a)': "36Ar, corrected for air interference",
+    '37Ar(ca)': "37Ar, corrected for Ca interference",
+    '38Ar(cl)': "38Ar, corrected for Cl interference",
+    '39Ar(k)': "39Ar, corrected for amount produced by K",
+    '40Ar(r)': "Radiogenic 40Ar measured abundance",
+    '40(r)/39(k)': "Ratio of radiogenic 40Ar to 39Ar from K",
+    'step_age': "Age calculated for a single heating step",
+    'plateau_age': "Age calculated for a plateau",
+    'total_fusion_age': "Age calculated for fusion of all heating steps",
+    '40Ar(r) [%]': "Radiogenic 40Ar, percent released in this step",
+    '39Ar(k) [%]': "39Ar from potassium, percent released in this step",
+    'K/Ca': "Potassium/Calcium ratio"
+}
+
+# Abbreviated material names used in some ArArCALC files
+material_names = {
+    'gmass': 'groundmass',
+    'plag': 'plagioclase'
+}
+
+# The type of age that is accepted by default for each technique
+accepted_ages = {
+    'Ar/Ar Incremental Heating': 'Age Plateau',
+    'Ar/Ar Fusion': 'Total Fusion Age'
+}
+
+def split_errors(values):
+    """
+    Split a series of "value ± error" strings (e.g. J-values and
+    standard ages) into a frame of numeric `value` and `error` columns.
+    """
+    parts = (values.astype(str)
+        .str.replace("Ma", "", regex=False)
+        .str.split("±", expand=True))
+    if parts.shape[1] < 2:
+        raise ValueError("Values have no ± error")
+    return DataFrame({
+        'value': to_numeric(parts[0].str.strip()),
+        'error': to_numeric(parts[1].str.strip())})
+
+# Values recorded for each heating step, besides temperature and errors
+heating_step_params = ['36Ar(a)','37Ar(ca)','38Ar(cl)','39Ar(k)',
+                       '40Ar(r)','39Ar(k) [%]','40Ar(r) [%]']
+
+def error_metric_label(label):
+    """Error metric from the label of an error column (e.g. "± 2σ")"""
+    return label.replace("± ","")
+
+# Columns of the results table that are imported as datums with errors
+result_columns = ['Age', 'K/Ca', '40(r)/39(k)']
+
+class ColumnSchema(object):
+    """
+    Positions of value columns in an ArArCALC table and of the error
+    column that follows each one, resolved once for the table.
+    """
+    def __init__(self, labels, columns):
+        labels = list(labels)
+        self.columns = list(columns)
+        self.value_ix = [labels.index(c) for c in columns]
+        self.error_ix = [ix+1 for ix in self.value_ix]
+        self.error_labels = {c: labels[ix] for c, ix in zip(columns, self.error_ix)}
+
+    def error_position(self, column):
+        return self.error_ix[self.columns.index(column)]
+
+    def error_metric(self, column):
+        return error_metric_label(self.error_labels[column])
+
+    def measurements(self, table, rows=None):
+        """
+        Numeric values and errors of the schema's columns, as two
+        frames labeled by column. Only `rows` are converted, if given.
+        """
+        if rows is not None:
+            table = table.loc[table.index.isin(rows)]
+        values = table.iloc[:, self.value_ix].apply(to_numeric)
+        errors = table.iloc[:, self.error_ix].apply(to_numeric)
+        values.columns = self.columns
+        errors.columns = self.columns
+        return values, errors
+
+
+class HeatingSteps(object):
+    """
+    Heating steps of an ArArCALC file, with a fixed schema of numeric
+    columns converted once when the file is parsed: values as a float64
+    array with a column for each of `value_columns`, errors of
+    `error_columns` as a second array, and a boolean plateau mask.
+    """
+    value_columns = ['temperature']+heating_step_params+['Age', 'K/Ca']
+    error_columns = ['Age', 'K/Ca']
+
+    def __init__(self, steps, in_plateau, values, errors, error_metrics):
+        # Labels of the heating steps (e.g. "1A")
+        self.steps = list(steps)
+        self.in_plateau = N.asarray(in_plateau, dtype=bool)
+        self.values = N.asarray(values, dtype=N.float64)
+        self.errors = N.asarray(errors, dtype=N.float64)
+        # Error metric of each error column (e.g. "2σ")
+        self.error_metrics = dict(error_metrics)
+
+    @classmethod
+    def from_frame(cls, table):
+        """
+        Convert a heating-step table sliced from the sheet, with an
+        `in_plateau` column of check marks and the error of each of
+        `error_columns` in the column that follows it.
+        """
+        schema = ColumnSchema(table.columns, cls.error_columns)
+        return cls(
+            steps=table.index,
+            in_plateau=table['in_plateau'].notnull().to_numpy(),
+            values=table[cls.value_columns].to_numpy(dtype=N.float64),
+            errors=table.iloc[:, schema.error_ix].to_numpy(dtype=N.float64),
+            error_metrics={c: schema.error_metric(c) for c in schema.columns})
+
+    def __len__(self):
+        return len(self.steps)
+
+    def value(self, column):
+        return self.values[:, self.value_columns.index(column)]
+
+    def error(self, column):
+        return self.errors[:, self.error_columns.index(column)]
+
+    def step(self, i):
+        """Values and errors of a heating step, as dicts of floats"""
+        return (dict(zip(self.value_columns, self.values[i].tolist())),
+                dict(zip(self.error_columns, self.errors[i].tolist())))
+
+    def to_frame(self):
+        """A labeled frame of the table, for display"""
+        df = DataFrame(self.values, index=self.steps, columns=self.value_columns)
+        df.insert(1, 'in_plateau', self.in_plateau)
+        for column, metric in self.error_metrics.items():
+            ix = df.columns.get_loc(column)+1
+            df.insert(ix, f"± {metric}", self.error(column), allow_duplicates=True)
+        df.index.name = 'Heating Step'
+        return df
@@ -0,0 +1,149 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from click import echo, secho
+from pandas import isna
+import numpy as N
+
+from .extract_tables import extract_data_tables
+from .transform import (material_names, accepted_ages, result_columns,
+                        split_errors, ColumnSchema)
+
+
+# Fields of the Information on Analysis table read by the importer
+info_fields = ['Sample', 'Material', 'Type', 'Project', 'J', 'Location',
+               'Analyst', 'Mass Discrimination Law']
+
+
+def check_info(info):
+    """Apply the transformations of `MAPImporter.import_session` and `general_info`"""
+    missing = [k for k in info_fields if k not in info.index or isna(info[k])]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    info = info.copy()
+    material = info.pop('Material')
+    res = dict(
+        sample=info.pop('Sample'),
+        material=material_names.get(material, material),
+        technique="Ar/Ar "+info.pop("Type"))
+    # J-value and standard ages, which are given as "value ± error"
+    for key in ['J', 'FC', 'AC']:
+        if key not in info.index or isna(info[key]):
+            continue
+        try:
+            measured = split_errors(info.reindex([key]))
+        except ValueError:
+            measured = None
+        if measured is None or measured.loc[key].isna().any():
+            raise ValueError(f"{key} is not a number ± error: {info[key]!r}")
+    return res
+
+
+def check_heating_steps(heating):
+    """
+    Check the heating steps, whose values are converted to numbers
+    when the file is parsed. Returns a summary and a list of warnings.
+    """
+    if len(heating) == 0:
+        raise ValueError("no heating steps")
+
+    warnings = []
+    for values, columns in [(heating.values, heating.value_columns),
+                            (heating.errors, [f"{c} error" for c in heating.error_columns])]:
+        for j, column in enumerate(columns):
+            blank = [step for step, v in zip(heating.steps, values[:, j]) if N.isnan(v)]
+            if blank:
+                warnings.append(f"no {column} for step {', '.join(map(str, blank))}")
+    plateau_steps = int(heating.in_plateau.sum())
+    return dict(steps=len(heating), plateau_steps=plateau_steps), warnings
+
+
+def check_results(results, technique):
+    """Check the values used by `MAPImporter.import_shared_parameters`"""
+    if 'Total Fusion Age' not in results.index:
+        raise ValueError("no Total Fusion Age row")
+    missing = [c for c in result_columns+['39Ar(k)'] if c not in results.columns]
+    if missing:
+        raise ValueError(f"missing columns {', '.join(missing)}")
+    schema = ColumnSchema(results.columns, result_columns)
+    for column, label in schema.error_labels.items():
+        if not isinstance(label, str):
+            raise ValueError(f"no error column after {column}")
+    values, errors = schema.measurements(results,
+        rows=['Age Plateau', 'Total Fusion Age'])
+
+    warnings = []
+    for row in values.index:
+        if isna(values.at[row, 'Age']):
+            raise ValueError(f"{row} has no Age")
+        for column in schema.columns:
+            if isna(errors.at[row, column]):
+                warnings.append(f"no {column} error for {row}")
+            if column != 'Age' and isna(values.at[row, column]):
+                warnings.append(f"no {column} for {row}")
+    if 'Age Plateau' in results.index:
+        v = results.loc['Age Plateau', '39Ar(k)']
+        try:
+            float(v)
+        except (TypeError, ValueError):
+            raise ValueError(f"Age Plateau 39Ar(k) is not a number: {v!r}")
+    ages = values['Age'].to_dict()
+
+    accepted = accepted_ages.get(technique)
+    if accepted is not None and accepted not in ages:
+        warnings.append(f"no {accepted} to accept for {technique}")
+    return dict(ages=ages), warnings
+
+
+def validate_file(fn):
+    """
+    Parse a file and run the importer's transformations on its
+    tables, without touching the database. Returns a report with
+    a summary of the file and any errors.
+    """
+    start = perf_counter()
+    report = dict(file=str(fn), errors=[], warnings=[])
+
+    def run(section, check, *args):
+        try:
+            return check(*args)
+        except Exception as exc:
+            report['errors'].append(f"{section}: {exc.__class__.__name__}: {exc}")
+
+    tables = run("parse", extract_data_tables, fn)
+    if tables is not None:
+        heating, info, results = tables
+        res = run("info", check_info, info)
+        if res is not None:
+            report.update(res)
+        res = run("heating steps", check_heating_steps, heating)
+        if res is not None:
+            report.update(res[0])
+            report['warnings'] += res[1]
+        res = run("results", check_results, results, report.get('technique'))
+        if res is not None:
+            report.update(res[0])
+            report['warnings'] += res[1]
+
+    report['ok'] = len(report['errors']) == 0
+    report['elapsed'] = perf_counter()-start
+    return report
+
+
+def validate_files(file_sequence, jobs=None):
+    """Validate files in a pool of worker processes, yielding reports in order"""
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(validate_file, file_sequence, chunksize=4)
+
+
+def print_report(report):
+    if not report['ok']:
+        secho(f"✗ {report['file']}", fg='red')
+        for error in report['errors']:
+            secho(f"    {error}", fg='red')
+        return
+    ages = ", ".join(f"{k} {v:.3f} Ma" for k, v in report.get('ages', {}).items())
+    echo(f"✓ {report['file']}")
+    secho(f"    {report['sample']} ({report['material']}), {report['technique']}, "
+          f"{report['steps']} steps, {ages}", dim=True)
+    for warning in report['warnings']:
+        secho(f"    {warning}", fg='yellow')
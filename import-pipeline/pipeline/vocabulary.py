@@ -0,0 +1,87 @@
+from collections import Counter
+from click import echo, secho
+from sqlalchemy import event
+
+
+class VocabularyCache(object):
+    """
+    Get-or-create results for vocabulary terms, kept for the lifetime
+    of an importer. The cache is emptied whenever the database session
+    rolls back, since objects created in the failed transaction will
+    no longer exist.
+    """
+    def __init__(self, session):
+        self._items = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        event.listen(session, "after_rollback", self.clear)
+
+    def get(self, kind, key, create, *args, **kwargs):
+        k = (kind, key)
+        if k in self._items:
+            self.hits[kind] += 1
+            return self._items[k]
+        self.misses[kind] += 1
+        v = create(*args, **kwargs)
+        self._items[k] = v
+        return v
+
+    def clear(self, *args):
+        self._items.clear()
+
+    def expunge(self):
+        """
+        Forget cached ORM objects, which are detached when the session is
+        expunged. Cached IDs are still valid, so they are kept until the
+        session rolls back.
+        """
+        self._items = {k: v for k, v in self._items.items() if isinstance(v, int)}
+
+    def report(self):
+        secho("Vocabulary cache", bold=True)
+        for kind in sorted(set(self.hits) | set(self.misses)):
+            hits = self.hits[kind]
+            total = hits + self.misses[kind]
+            rate = 100*hits/total
+            echo(f"  {kind:<14}{hits:>8} hits {total-hits:>6} misses  ({rate:.0f}% hit rate)")
+
+
+def cache_key(args, kwargs):
+    return (args, tuple(sorted(kwargs.items())))
+
+
+class CachedVocabularyMixin(object):
+    """
+    Caches lookups of parameters, units, error metrics, materials,
+    methods and instruments for an importer, so that repeated terms
+    don't require a database query.
+    """
+    @property
+    def vocabulary(self):
+        if getattr(self, '_vocabulary', None) is None:
+            self._vocabulary = VocabularyCache(self.db.session)
+        return self._vocabulary
+
+    def parameter(self, *args, **kwargs):
+        return self.vocabulary.get('parameter', cache_key(args, kwargs),
+            super().parameter, *args, **kwargs)
+
+    def unit(self, *args, **kwargs):
+        return self.vocabulary.get('unit', cache_key(args, kwargs),
+            super().unit, *args, **kwargs)
+
+    def error_metric(self, *args, **kwargs):
+        return self.vocabulary.get('error_metric', cache_key(args, kwargs),
+            super().error_metric, *args, **kwargs)
+
+    def material(self, *args, **kwargs):
+        return self.vocabulary.get('material', cache_key(args, kwargs),
+            super().material, *args, **kwargs)
+
+    def method(self, *args, **kwargs):
+        return self.vocabulary.get('method', cache_key(args, kwargs),
+            super().method, *args, **kwargs)
+
+    def instrument(self, name):
+        return self.vocabulary.get('instrument', name,
+            self.db.get_or_create, self.m.instrument, name=name)
@@ -0,0 +1,189 @@
+from fnmatch import fnmatch
+from os import scandir, stat
+from pathlib import Path
+from queue import Queue, Empty
+from time import monotonic, sleep
+
+
+class FileWatcher(object):
+    """
+    Watches a directory tree for new or changed files matching
+    `pattern`, and yields them in batches once they have stopped
+    changing, so that files that are still being copied in aren't
+    imported. Files that already exist when watching starts are
+    not reported.
+
+    Uses filesystem notifications if `watchdog` is installed. Otherwise
+    directories are polled every `poll_interval` seconds: each known
+    directory is checked with `stat`, and only those whose modification
+    time has changed are listed again. Files overwritten in place don't
+    change their directory, so the known files are also checked every
+    `rescan_interval` seconds.
+
+    :param settle: seconds a file's size and modification time must be
+        unchanged before it is considered complete
+    :param batch_window: longest time to wait for files that are still
+        changing before yielding those that are ready
+    """
+    def __init__(self, directory, pattern="*.xls", settle=2.0, batch_window=10.0,
+                 poll_interval=5.0, rescan_interval=60.0):
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.settle = settle
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.last_rescan = None
+        # Files waiting to settle: path → ((size, mtime), time of last change)
+        self.pending = {}
+        self.events = Queue()
+        self.observer = None
+        # For polling: directory → (modification time, subdirectories),
+        # and the sizes and modification times of matching files
+        self.directories = {}
+        self.files = {}
+
+    def matches(self, fn):
+        name = Path(fn).name
+        # Skip Excel lock files of workbooks that are open
+        return fnmatch(name, self.pattern) and not name.startswith("~$")
+
+    def start(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            self.poll()
+            return self
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                watcher.events.put(getattr(event, 'dest_path', None) or event.src_path)
+
+        self.observer = Observer()
+        self.observer.schedule(Handler(), str(self.directory), recursive=True)
+        self.observer.start()
+        return self
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    @property
+    def method(self):
+        return "polling" if self.observer is None else "notifications"
+
+    def poll(self):
+        """
+        Queue new or changed files in directories that have changed since
+        the last poll, and in all known files every `rescan_interval`
+        seconds. The first poll only records the current state.
+        """
+        initial = not self.directories
+        stack = [self.directory]
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = stat(d).st_mtime
+            except FileNotFoundError:
+                self.directories.pop(d, None)
+                continue
+            known = self.directories.get(d)
+            if known is not None and known[0] == mtime:
+                stack.extend(known[1])
+                continue
+            subdirs = []
+            try:
+                for entry in scandir(d):
+                    if entry.is_dir():
+                        subdirs.append(Path(entry.path))
+                    elif self.matches(entry.path):
+                        self.check_file(entry.path, queue=not initial)
+            except FileNotFoundError:
+                continue
+            self.directories[d] = (mtime, subdirs)
+            stack.extend(subdirs)
+
+        now = monotonic()
+        if self.last_rescan is None:
+            self.last_rescan = now
+        elif now-self.last_rescan >= self.rescan_interval:
+            self.last_rescan = now
+            for fn in list(self.files):
+                self.check_file(fn)
+
+    def check_file(self, fn, queue=True):
+        try:
+            st = stat(fn)
+        except FileNotFoundError:
+            self.files.pop(fn, None)
+            return
+        key = (st.st_size, st.st_mtime)
+        if self.files.get(fn) != key:
+            self.files[fn] = key
+            if queue:
+                self.events.put(fn)
+
+    def wait(self, timeout):
+        """Collect the paths of file events for up to `timeout` seconds"""
+        if self.observer is None:
+            sleep(timeout)
+            self.poll()
+            timeout = 0
+        fns = []
+        try:
+            fns.append(self.events.get(timeout=timeout))
+            while True:
+                fns.append(self.events.get_nowait())
+        except Empty:
+            pass
+        return fns
+
+    def settled(self):
+        """Pending files whose size and modification time haven't changed recently"""
+        now = monotonic()
+        ready = []
+        for fn, (key, changed) in list(self.pending.items()):
+            try:
+                st = stat(fn)
+            except FileNotFoundError:
+                del self.pending[fn]
+                continue
+            current = (st.st_size, st.st_mtime)
+            if current != key:
+                self.pending[fn] = (current, now)
+            elif now-changed >= self.settle:
+                ready.append(fn)
+        return ready
+
+    def batches(self, idle=False):
+        """
+        Yield sorted lists of files that are ready to import. Files that
+        settle around the same time are imported together. If `idle` is
+        set, an empty list is yielded after each wait without a batch,
+        so that the caller can do deferred work.
+        """
+        first_ready = None
+        while True:
+            timeout = min(self.settle, self.poll_interval) if self.pending else self.poll_interval
+            for fn in self.wait(timeout):
+                if self.matches(fn):
+                    # Check the file again before importing it
+                    self.pending[Path(fn)] = (None, monotonic())
+            ready = self.settled()
+            if ready and first_ready is None:
+                first_ready = monotonic()
+            if not ready or (len(ready) < len(self.pending)
+                             and monotonic()-first_ready < self.batch_window):
+                if idle:
+                    yield []
+                continue
+            for fn in ready:
+                del self.pending[fn]
+            first_ready = None
+            yield sorted(ready)
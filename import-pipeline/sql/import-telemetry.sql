@@ -0,0 +1,33 @@
+/*
+Records of import runs and of each file imported in them, written by
+the import pipeline (see pipeline/telemetry.py) and summarized by the
+`import-telemetry` backend plugin route.
+*/
+CREATE TABLE IF NOT EXISTS import_run (
+  id serial PRIMARY KEY,
+  importer text NOT NULL,
+  started timestamptz NOT NULL DEFAULT now(),
+  finished timestamptz,
+  options jsonb,
+  n_files integer,
+  n_failed integer
+);
+
+CREATE TABLE IF NOT EXISTS import_file (
+  id serial PRIMARY KEY,
+  run_id integer NOT NULL REFERENCES import_run(id) ON DELETE CASCADE,
+  file text NOT NULL,
+  recorded timestamptz NOT NULL DEFAULT now(),
+  -- Seconds spent parsing files and writing to the database
+  parse_time double precision,
+  db_time double precision,
+  total_time double precision,
+  -- Rows written, e.g. {"sessions": 1, "analyses": 14, "datums": 130}
+  counts jsonb,
+  error_class text,
+  error text
+);
+
+CREATE INDEX IF NOT EXISTS import_file_run_id ON import_file (run_id);
+
+COMMIT;
@@ -0,0 +1,37 @@
+/*
+Indexes for the WiscAr schema extensions and for the queries that
+join datum → datum_type → analysis → session, such as `clean-data.sql`
+and the `metrics` and `export` backend plugins. Compare query plans
+with and without them using `python -m benchmarks.indexes`.
+*/
+
+/*
+Join keys, with the columns the hot queries filter on. Each index on
+analysis and datum slows down bulk imports, so only one is kept for
+analysis: it serves the cleanup queries, which select the few age
+analyses by type, and the per-session lookups of the bulk writer.
+datum_type is small enough to be scanned.
+*/
+CREATE INDEX IF NOT EXISTS datum_type_analysis ON datum (type, analysis);
+CREATE INDEX IF NOT EXISTS analysis_type_session ON analysis (analysis_type, session_id);
+CREATE INDEX IF NOT EXISTS session_technique ON session (technique, id);
+CREATE INDEX IF NOT EXISTS session_sample ON session (sample_id);
+CREATE INDEX IF NOT EXISTS session_project ON session (project_id);
+
+/* Accepted ages are a small fraction of all datums */
+CREATE INDEX IF NOT EXISTS datum_accepted ON datum (type, analysis)
+  WHERE is_accepted;
+
+/* Plateau steps of each session */
+CREATE INDEX IF NOT EXISTS analysis_in_plateau ON analysis (session_id, session_index)
+  WHERE in_plateau;
+
+/* Key and containment queries on result columns stored by the importer */
+CREATE INDEX IF NOT EXISTS analysis_data ON analysis USING gin (data);
+
+ANALYZE datum;
+ANALYZE datum_type;
+ANALYZE analysis;
+ANALYZE session;
+
+COMMIT;
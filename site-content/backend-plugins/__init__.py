@@ -2,45 +2,531 @@ from sparrow.plugins import SparrowPlugin
 from sparrow.context import app_context
 from sparrow.util import relative_path
 from starlette.routing import Route, Router
-from starlette.responses import JSONResponse
-import pandas as pd
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock
+from os import environ, replace
 from pathlib import Path
+from time import monotonic
+from datetime import date, datetime
+from decimal import Decimal
+import asyncio
+import shutil
+import csv
+import io
 import json
+import hashlib
 
 
-class MetricsEndpointWiscAr(SparrowPlugin):
+class QueryPool(object):
+    '''
+        Runs blocking database queries for lab routes on a thread pool,
+        with a connection pool of its own so that slow lab queries
+        can't starve the rest of the API of connections.
+    '''
+    def __init__(self, db, size=4):
+        self.engine = create_engine(db.engine.url, pool_size=size, max_overflow=0)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="lab-route")
+
+    def _query(self, sql, params, timeout):
+        with self.engine.begin() as conn:
+            if timeout is not None:
+                # Stop the query on the server if the request times out
+                conn.execute(text("SELECT set_config('statement_timeout', :ms, true)"),
+                             ms=str(int(timeout*1000)))
+            res = conn.execute(text(sql), **params)
+            keys = list(res.keys())
+            return [dict(zip(keys, row)) for row in res]
+
+    async def query(self, sql, timeout=None, **params):
+        '''
+            Run a query without blocking the event loop, returning
+            its rows as dicts.
+        '''
+        return await self.run(self._query, sql, params, timeout)
+
+    async def run(self, func, *args):
+        '''
+            Run other blocking work (e.g. file access) on the pool's threads.
+        '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+
+def jsonable(rows):
+    '''
+        Convert dates in query results to ISO strings for JSONResponse.
+    '''
+    return [{k: v.isoformat() if isinstance(v, (date, datetime)) else v
+             for k, v in row.items()} for row in rows]
+
+
+def lab_route(path, description=None, timeout=10, max_concurrent=4, methods=['GET']):
+    '''
+        Mark an async plugin method as a route handler. Requests that
+        take longer than `timeout` seconds get a 504 response, and at
+        most `max_concurrent` requests are handled at once.
+    '''
+    def decorator(func):
+        func.lab_route = dict(path=path, description=description, timeout=timeout,
+                              max_concurrent=max_concurrent, methods=methods)
+        return func
+    return decorator
+
+
+class AsyncRoutesMixin(object):
+    '''
+        Registers the `lab_route` handlers of a plugin with the API,
+        under the "Lab Plugins" route descriptions. Handlers can run
+        queries through `self.pool`, and read queries from SQL files
+        in this directory with `self.sql`.
+    '''
+    root_route = "Lab Plugins"
+    pool_size = 4
+    _pool = None
+
+    def sql(self, name):
+        return Path(relative_path(__file__, name)).read_text()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = QueryPool(self.app.database, size=self.pool_size)
+        return self._pool
+
+    def endpoint(self, handler, spec):
+        limit = None
+
+        async def limited(request):
+            nonlocal limit
+            # Created on first use so it belongs to the server's event loop
+            if limit is None:
+                limit = asyncio.Semaphore(spec['max_concurrent'])
+            async with limit:
+                return await handler(request)
+
+        async def endpoint(request):
+            try:
+                return await asyncio.wait_for(limited(request), spec['timeout'])
+            except asyncio.TimeoutError:
+                return JSONResponse({"error": "Request timed out"}, status_code=504)
+        return endpoint
+
+    def on_api_initialized_v2(self, api):
+        for name in dir(type(self)):
+            spec = getattr(getattr(type(self), name), 'lab_route', None)
+            if spec is None:
+                continue
+            handler = self.endpoint(getattr(self, name), spec)
+            api.add_route(spec['path'], handler, methods=spec['methods'], include_in_schema=False)
+            api.route_descriptions[self.root_route].append(dict(
+                route=spec['path'],
+                description=spec['description'],
+            ))
+
+
+class MetricsEndpointWiscAr(AsyncRoutesMixin, SparrowPlugin):
     '''
         This Sparrow Plugin adds a GET route to the API. 
         It works by reading in a postgreSQL query from a 
-        file in this directory, querying the sparrow 
-        database, and then returning the response a JSON.
+        file in this directory, and storing its result in a
+        materialized view that is refreshed after each import.
+        The view is recreated when the query changes, and records when
+        it was last refreshed so that the in-memory cache in front of it
+        is replaced as soon as new metrics are available.
 
-        It then uses the on_api_initialized_v2 hook to add the route
-        and some route documentation that shows up on the api.
+        The route is an async handler registered by AsyncRoutesMixin,
+        so the query runs off the event loop.
     '''
     name = 'metrics'
+    view_name = 'wiscar_metrics'
+    # Seconds between checks of whether the view has been refreshed
+    check_interval = 5
 
-    def metrics_view(self):
+    _cached = None
+    _checked = None
 
-        db = self.app.database
-        p = Path(relative_path(__file__, "metrics.sql"))
-        sqlfile = open(p, "r")
-        query = sqlfile.read()
+    def on_database_ready(self, db):
+        query = self.sql("metrics.sql").strip().rstrip(";")
+        definition = f"SELECT *, now() AS refreshed_at FROM ({query}) metrics"
+        # The view's comment identifies the query it was created from
+        version = hashlib.sha1(definition.encode()).hexdigest()
+        with db.engine.begin() as conn:
+            current = conn.execute(text(
+                "SELECT obj_description(to_regclass(:name), 'pg_class')"),
+                name=self.view_name).scalar()
+            if current == version:
+                return
+            conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {self.view_name}"))
+            conn.execute(text(f"CREATE MATERIALIZED VIEW {self.view_name} AS {definition}"))
+            # Allows `REFRESH MATERIALIZED VIEW CONCURRENTLY`, which doesn't block readers
+            conn.execute(text(f"CREATE UNIQUE INDEX {self.view_name}_refreshed_at "
+                              f"ON {self.view_name} (refreshed_at)"))
+            conn.execute(text(f"COMMENT ON MATERIALIZED VIEW {self.view_name} IS '{version}'"))
 
-        metrics = db.exec_query(query)
-        res = metrics.to_json(orient='records')
+    async def get_metrics(self):
+        now = monotonic()
+        if self._checked is None or now - self._checked > self.check_interval:
+            res = await self.pool.query(f"SELECT max(refreshed_at) AS refreshed_at "
+                                        f"FROM {self.view_name}", timeout=10)
+            refreshed_at = res[0]['refreshed_at']
+            if self._cached is None or self._cached[0] != refreshed_at:
+                rows = await self.pool.query(f"SELECT * FROM {self.view_name}", timeout=10)
+                self._cached = (refreshed_at, jsonable(rows))
+            self._checked = now
+        return self._cached[1]
 
-        return JSONResponse(json.loads(res))
+    @lab_route("/metrics", description="A metrics route for WiscAr Lab", timeout=15)
+    async def metrics_view(self, request):
+        return JSONResponse(await self.get_metrics())
 
-    def on_api_initialized_v2(self, api):
-        
-        root_route = "Lab Plugins"
-        basic_info = dict(
-            route = "/metrics",
-            description = "A metrics route for WiscAr Lab",
-        )
-        api.add_route("/metrics", self.metrics_view(), methods=['GET'], include_in_schema=False)
-        api.route_descriptions[root_route].append(basic_info)
+
+class ImportTelemetryWiscAr(AsyncRoutesMixin, SparrowPlugin):
+    '''
+        Adds a GET route that summarizes the import telemetry tables
+        written by the import pipeline: throughput of recent runs and
+        failures grouped by error class, so that slowdowns and
+        recurring errors in nightly imports can be spotted.
+    '''
+    name = 'import-telemetry'
+
+    @lab_route("/import-telemetry",
+               description="Throughput and errors of recent WiscAr data imports",
+               timeout=15)
+    async def telemetry_view(self, request):
+        params = {}
+        for name in ("runs", "days"):
+            value = request.query_params.get(name, "30")
+            try:
+                params[name] = int(value)
+                if params[name] < 1:
+                    raise ValueError(value)
+            except ValueError:
+                return JSONResponse({"error": f"{name} must be a positive integer, not {value!r}"},
+                                    status_code=400)
+        limit, days = params["runs"], params["days"]
+        runs = await self.pool.query(self.sql("import_throughput.sql"), timeout=10, limit=limit)
+        errors = await self.pool.query(self.sql("import_errors.sql"), timeout=10, days=days)
+        return JSONResponse(dict(runs=jsonable(runs), errors=jsonable(errors)))
+
+
+class TileCache(object):
+    '''
+        Vector tiles kept in an in-memory LRU in front of an on-disk
+        cache. Tiles are stored by data version, and tiles of earlier
+        versions are discarded when the version changes.
+    '''
+    def __init__(self, directory, size=2048):
+        self.directory = Path(directory)
+        self.size = size
+        self.version = None
+        self.tiles = OrderedDict()
+        self.lock = Lock()
+
+    def path(self, version, z, x, y):
+        return self.directory/str(version)/str(z)/str(x)/f"{y}.pbf"
+
+    def set_version(self, version):
+        with self.lock:
+            if version == self.version:
+                return
+            self.version = version
+            self.tiles.clear()
+        if self.directory.exists():
+            for p in self.directory.iterdir():
+                if p.name != str(version):
+                    shutil.rmtree(p, ignore_errors=True)
+
+    def remember(self, key, data):
+        with self.lock:
+            self.tiles[key] = data
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.size:
+                self.tiles.popitem(last=False)
+
+    def get(self, version, z, x, y):
+        key = (version, z, x, y)
+        with self.lock:
+            data = self.tiles.get(key)
+            if data is not None:
+                self.tiles.move_to_end(key)
+                return data
+        p = self.path(*key)
+        if not p.exists():
+            return None
+        data = p.read_bytes()
+        self.remember(key, data)
+        return data
+
+    def put(self, version, z, x, y, data):
+        # Tiles generated before a version change are not kept
+        if version != self.version:
+            return
+        key = (version, z, x, y)
+        self.remember(key, data)
+        p = self.path(*key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        replace(tmp, p)
+
+
+class SampleTilesWiscAr(AsyncRoutesMixin, SparrowPlugin):
+    '''
+        Serves sample locations as Mapbox vector tiles generated by
+        PostGIS, so that maps don't have to load every sample's
+        geometry through the API.
+
+        Tiles are cached in memory and on disk. Triggers on the sample
+        table increment a version counter when samples with locations
+        are added, removed, moved or renamed (e.g. by the metadata
+        import), which discards the cached tiles.
+    '''
+    name = 'sample-tiles'
+    media_type = "application/vnd.mapbox-vector-tile"
+    # Seconds between checks of the tile version
+    version_ttl = 10
+    max_zoom = 22
+
+    _tile_cache = None
+    _version = None
+
+    def on_database_ready(self, db):
+        with db.engine.begin() as conn:
+            conn.execute(text(self.sql("sample_tiles.sql")))
+
+    @property
+    def tile_cache(self):
+        if self._tile_cache is None:
+            directory = environ.get("SPARROW_TILE_CACHE_DIR", "/tmp/sparrow-wiscar-tiles")
+            self._tile_cache = TileCache(directory)
+        return self._tile_cache
+
+    async def tile_version(self):
+        now = monotonic()
+        if self._version is None or now - self._version[0] > self.version_ttl:
+            rows = await self.pool.query("SELECT version FROM wiscar_tile_version")
+            self._version = (now, rows[0]['version'])
+            await self.pool.run(self.tile_cache.set_version, self._version[1])
+        return self._version[1]
+
+    @lab_route("/tiles/{z:int}/{x:int}/{y:int}.pbf",
+               description="Vector tiles of sample locations",
+               timeout=20, max_concurrent=8)
+    async def tile_view(self, request):
+        z, x, y = (request.path_params[k] for k in ("z", "x", "y"))
+        if z > self.max_zoom or not (0 <= x < 2**z and 0 <= y < 2**z):
+            return Response(status_code=404)
+
+        version = await self.tile_version()
+        cache = self.tile_cache
+        data = await self.pool.run(cache.get, version, z, x, y)
+        if data is None:
+            rows = await self.pool.query(self.sql("sample_tile.sql"), timeout=15, z=z, x=x, y=y)
+            data = bytes(rows[0]['tile'] or b"")
+            await self.pool.run(cache.put, version, z, x, y, data)
+        # Clients may reuse a tile until the server's version check would notice a change
+        headers = {"Cache-Control": f"public, max-age={self.version_ttl}"}
+        return Response(data, media_type=self.media_type, headers=headers)
+
+
+class ExportStream(object):
+    '''
+        Reads the rows of an export query through a server-side cursor
+        and encodes them in chunks, so that only one chunk is held in
+        memory at a time. All methods block, and are run on the query
+        pool's threads; the lock keeps `close` from running during a read.
+    '''
+    formats = {
+        "csv": "text/csv",
+        "ndjson": "application/x-ndjson",
+        "arrow": "application/vnd.apache.arrow.stream",
+    }
+    # Arrow types of the columns of export.sql
+    arrow_types = dict(
+        session_id="int64", analysis_id="int64", session_index="int64",
+        in_plateau="bool", is_accepted="bool", value="float64", error="float64",
+        date="timestamp[us]")
+
+    def __init__(self, engine, sql, params, format="csv", chunk_size=5000):
+        self.engine = engine
+        self.sql = sql
+        self.params = params
+        self.format = format
+        self.chunk_size = chunk_size
+        self.conn = None
+        self.result = None
+        self.finished = False
+        self.lock = Lock()
+
+    def open(self):
+        '''
+            Start the query, returning the header of the export.
+        '''
+        with self.lock:
+            self.conn = self.engine.connect().execution_options(stream_results=True)
+            self.result = self.conn.execute(text(self.sql), **self.params)
+            self.keys = list(self.result.keys())
+            return getattr(self, f"{self.format}_header")()
+
+    def read(self):
+        '''
+            Encode the next chunk of rows, or return None at the end.
+        '''
+        with self.lock:
+            if self.finished:
+                return None
+            rows = self.result.fetchmany(self.chunk_size)
+            if not rows:
+                self.finished = True
+                return getattr(self, f"{self.format}_footer", lambda: b"")()
+            rows = [[float(v) if isinstance(v, Decimal) else v for v in row] for row in rows]
+            return getattr(self, f"{self.format}_rows")(rows)
+
+    def close(self):
+        with self.lock:
+            self.finished = True
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def csv_header(self):
+        return self.csv_rows([self.keys])
+
+    def csv_rows(self, rows):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow([json.dumps(v) if isinstance(v, dict) else v for v in row])
+        return buf.getvalue().encode()
+
+    def ndjson_header(self):
+        return b""
+
+    def ndjson_rows(self, rows):
+        lines = (json.dumps(dict(zip(self.keys, row)), default=str) for row in rows)
+        return "".join(line+"\n" for line in lines).encode()
+
+    def arrow_header(self):
+        import pyarrow as pa
+        self.schema = pa.schema([(k, self.arrow_types.get(k, "string")) for k in self.keys])
+        self.buffer = io.BytesIO()
+        self.writer = pa.ipc.new_stream(self.buffer, self.schema)
+        return self.drain()
+
+    def arrow_rows(self, rows):
+        import pyarrow as pa
+        columns = []
+        for field, values in zip(self.schema, zip(*rows)):
+            if field.type == pa.string():
+                values = [json.dumps(v) if isinstance(v, dict) else v for v in values]
+                values = [None if v is None else str(v) for v in values]
+            columns.append(pa.array(values, type=field.type))
+        self.writer.write_batch(pa.record_batch(columns, schema=self.schema))
+        return self.drain()
+
+    def arrow_footer(self):
+        self.writer.close()
+        return self.drain()
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+class ExportWiscAr(AsyncRoutesMixin, SparrowPlugin):
+    '''
+        Adds a GET route that exports datums along with their analysis,
+        session, sample and project, as CSV, newline-delimited JSON or
+        an Arrow IPC stream. Rows are read through a server-side cursor
+        and streamed in chunks, so memory use on the API server does not
+        depend on the size of the export.
+
+        Filters are given as query parameters, e.g.
+        `/export?format=ndjson&project=...&sample=...&technique=...`.
+        At most `max_exports` exports run at once, each holding one of
+        the plugin's connections until its stream is closed; further
+        requests get a 503 response rather than waiting for a connection.
+    '''
+    name = 'export'
+    max_exports = 2
+    pool_size = max_exports
+    chunk_size = 5000
+    filters = ('project', 'sample', 'technique')
+
+    _exports = None
+
+    @property
+    def exports(self):
+        # Streams holding one of the export slots
+        if self._exports is None:
+            self._exports = set()
+        return self._exports
+
+    def release(self, stream):
+        '''
+            Close a stream and free its slot. Safe to call more than once.
+        '''
+        if stream in self.exports:
+            self.exports.discard(stream)
+            # Runs after any blocking call in progress, as the stream is locked
+            self.pool.executor.submit(stream.close)
+
+    async def run_stream(self, stream, method):
+        future = self.pool.executor.submit(method)
+        try:
+            return await asyncio.wrap_future(future)
+        except BaseException:
+            self.release(stream)
+            raise
+
+    async def chunks(self, stream, header):
+        try:
+            yield header
+            while True:
+                data = await self.run_stream(stream, stream.read)
+                if data is None:
+                    break
+                if data:
+                    yield data
+        finally:
+            self.release(stream)
+
+    @lab_route("/export",
+               description="Stream WiscAr data as CSV, NDJSON or Arrow, filtered by project, sample or technique",
+               timeout=60)
+    async def export_view(self, request):
+        format = request.query_params.get("format", "csv")
+        media_type = ExportStream.formats.get(format)
+        if media_type is None:
+            return JSONResponse({"error": f"Unknown format {format}"}, status_code=400)
+        if format == "arrow":
+            try:
+                import pyarrow
+            except ImportError:
+                return JSONResponse({"error": "Arrow export requires pyarrow"}, status_code=400)
+
+        if len(self.exports) >= self.max_exports:
+            return JSONResponse({"error": "Too many exports in progress"},
+                                status_code=503, headers={"Retry-After": "30"})
+
+        params = {k: request.query_params.get(k) for k in self.filters}
+        stream = ExportStream(self.pool.engine, self.sql("export.sql"), params,
+                              format=format, chunk_size=self.chunk_size)
+        # Claimed before the first await, so concurrent requests can't overshoot
+        self.exports.add(stream)
+        header = await self.run_stream(stream, stream.open)
+        ext = "arrows" if format == "arrow" else format
+        headers = {"Content-Disposition": f'attachment; filename="wiscar-export.{ext}"'}
+        # The background task also runs if the client disconnects before
+        # the first chunk, in which case `chunks` never starts
+        return StreamingResponse(self.chunks(stream, header), media_type=media_type, headers=headers,
+                                 background=BackgroundTask(self.release, stream))
 
 
 class AddNewTable(SparrowPlugin):
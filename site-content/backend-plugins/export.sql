@@ -0,0 +1,33 @@
+/**
+All datums with their analysis, session, sample and project, one row
+per datum. Filters are skipped when their parameter is NULL. Rows are
+not sorted, so that they can be streamed as soon as they are found.
+*/
+SELECT
+  p.name project,
+  s.name sample,
+  s.material,
+  sess.id session_id,
+  sess.technique,
+  sess.date,
+  a.id analysis_id,
+  a.analysis_type,
+  a.analysis_name,
+  a.session_index,
+  a.in_plateau,
+  dt.parameter,
+  dt.unit,
+  d.value,
+  d.error,
+  dt.error_metric,
+  d.is_accepted,
+  a.data
+FROM datum d
+JOIN datum_type dt ON d.type = dt.id
+JOIN analysis a ON d.analysis = a.id
+JOIN session sess ON a.session_id = sess.id
+LEFT JOIN sample s ON sess.sample_id = s.id
+LEFT JOIN project p ON sess.project_id = p.id
+WHERE (CAST(:project AS text) IS NULL OR p.name = :project)
+  AND (CAST(:sample AS text) IS NULL OR s.name = :sample)
+  AND (CAST(:technique AS text) IS NULL OR sess.technique = :technique)
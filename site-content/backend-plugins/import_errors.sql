@@ -0,0 +1,15 @@
+/**
+Import failures by error class over recent runs
+*/
+SELECT
+  r.importer,
+  f.error_class,
+  count(*) n_files,
+  max(f.recorded) last_seen,
+  (array_agg(f.file ORDER BY f.recorded DESC))[1:5] recent_files
+FROM import_file f
+JOIN import_run r ON r.id = f.run_id
+WHERE f.error_class IS NOT NULL
+  AND f.recorded > now() - make_interval(days => :days)
+GROUP BY r.importer, f.error_class
+ORDER BY n_files DESC;
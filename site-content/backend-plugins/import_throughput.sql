@@ -0,0 +1,21 @@
+/**
+Throughput of recent import runs, from the telemetry tables
+written by the import pipeline
+*/
+SELECT
+  r.id,
+  r.importer,
+  r.started,
+  r.finished,
+  count(f.id) n_files,
+  count(f.error_class) n_failed,
+  sum(f.parse_time) parse_time,
+  sum(f.db_time) db_time,
+  sum((f.counts->>'datums')::integer) n_datums,
+  (count(f.id)/NULLIF(extract(epoch FROM r.finished - r.started), 0))::double precision files_per_second,
+  sum((f.counts->>'datums')::integer)/NULLIF(sum(f.db_time), 0) datums_per_db_second
+FROM import_run r
+LEFT JOIN import_file f ON f.run_id = r.id
+GROUP BY r.id
+ORDER BY r.started DESC
+LIMIT :limit;
@@ -0,0 +1,17 @@
+/**
+Mapbox vector tile of sample locations for tile z/x/y
+*/
+WITH bounds AS (
+  SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+),
+mvt AS (
+  SELECT
+    ST_AsMVTGeom(ST_Transform(s.location, 3857), bounds.geom) AS geom,
+    s.id,
+    s.name,
+    s.material
+  FROM sample s, bounds
+  WHERE s.location IS NOT NULL
+    AND s.location && ST_Transform(bounds.geom, 4326)
+)
+SELECT ST_AsMVT(mvt, 'samples', 4096, 'geom') AS tile FROM mvt;
@@ -0,0 +1,58 @@
+/**
+Version counter for the sample vector tiles, which is incremented
+whenever samples with locations are added, removed or changed so that
+cached tiles are invalidated. The statement-level triggers compare
+old and new rows, so imports that don't change any mapped sample
+(e.g. rewriting existing values) leave the cache in place.
+*/
+CREATE TABLE IF NOT EXISTS wiscar_tile_version (
+  id boolean PRIMARY KEY DEFAULT true CHECK (id),
+  version integer NOT NULL DEFAULT 0
+);
+
+INSERT INTO wiscar_tile_version (id, version) VALUES (true, 0)
+ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION wiscar_sample_tiles_changed() RETURNS trigger AS $$
+DECLARE
+  changed boolean;
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    SELECT EXISTS (SELECT 1 FROM new_samples WHERE location IS NOT NULL) INTO changed;
+  ELSIF TG_OP = 'DELETE' THEN
+    SELECT EXISTS (SELECT 1 FROM old_samples WHERE location IS NOT NULL) INTO changed;
+  ELSE
+    SELECT EXISTS (
+      SELECT 1
+      FROM old_samples o
+      JOIN new_samples n ON n.id = o.id
+      WHERE (o.location IS NOT NULL OR n.location IS NOT NULL)
+        AND (ST_AsEWKB(o.location) IS DISTINCT FROM ST_AsEWKB(n.location)
+          OR o.name IS DISTINCT FROM n.name
+          OR o.material IS DISTINCT FROM n.material)
+    ) INTO changed;
+  END IF;
+  IF changed THEN
+    UPDATE wiscar_tile_version SET version = version + 1;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS wiscar_sample_tiles_inserted ON sample;
+CREATE TRIGGER wiscar_sample_tiles_inserted
+AFTER INSERT ON sample
+REFERENCING NEW TABLE AS new_samples
+FOR EACH STATEMENT EXECUTE PROCEDURE wiscar_sample_tiles_changed();
+
+DROP TRIGGER IF EXISTS wiscar_sample_tiles_updated ON sample;
+CREATE TRIGGER wiscar_sample_tiles_updated
+AFTER UPDATE ON sample
+REFERENCING OLD TABLE AS old_samples NEW TABLE AS new_samples
+FOR EACH STATEMENT EXECUTE PROCEDURE wiscar_sample_tiles_changed();
+
+DROP TRIGGER IF EXISTS wiscar_sample_tiles_deleted ON sample;
+CREATE TRIGGER wiscar_sample_tiles_deleted
+AFTER DELETE ON sample
+REFERENCING OLD TABLE AS old_samples
+FOR EACH STATEMENT EXECUTE PROCEDURE wiscar_sample_tiles_changed();